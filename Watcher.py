@@ -4,11 +4,21 @@ import sys
 import glob
 import shutil
 import csv
+import threading
+import unicodedata
 from datetime import datetime
 from config import ConfigManager
 from rag import RAGManager
 from engine import AIEngine
-from pypdf import PdfReader
+from box_watch import SETTLE_INTERVAL, ReadyFilter, make_box_watcher, scan_requests
+from scheduler import RequestScheduler
+from pdf_review import (FAILED_TEXT, PageFeeder, ReviewPool, generate_page, is_clean, iter_packs, pack_budget,
+                        page_cache_key, report_text, review_pack, review_pages_parallel, with_page)
+from result_cache import ResultCache, make_key, model_fingerprint
+from prescreen import PreScreen
+from metrics import METRICS, setup_logging
+from http_channel import HttpChannel
+from fleet import Fleet, is_fleet_file, request_uid
 
 class AIWatcher:
     def __init__(self):
@@ -29,16 +39,81 @@ class AIWatcher:
         if not os.path.exists(self.log_file):
             with open(self.log_file, "w", encoding="cp932", newline="", errors="replace") as f:
                 writer = csv.writer(f)
-                writer.writerow(["日時", "ユーザーID", "質問内容", "AI回答"])
+                writer.writerow(["日時", "ユーザーID", "質問内容", "AI回答", "備考"])
 
         print("だんご大家族（PDF査読・スマートリスト対応版）を起動します...")
+        self.scheduler = None
+        self.http = None
+        self.fleet = None
+        self.hosts = 1
+        # 複数台の時に status.txt を書く台か（10秒ごとに生きている台から決め直します）
+        self.publishes_status = True
+        # PDFレーンのワーカーごとの並列査読用プロセスプール {AIEngine: ReviewPool}
+        self.review_pools = {}
+        self.review_pools_lock = threading.Lock()
+        self.history_lock = threading.Lock()
+        # 順番待ちの質問について先に済ませておいた検索結果 {依頼ファイル: (DB世代, 質問, 参照テキスト, 出典)}
+        self.prefetched = {}
+        self.prefetch_lock = threading.Lock()
+        self.prefetching = False
         self.cleanup_box(max_age_minutes=10)
         
         self.config = ConfigManager(self.base_dir)
+        setup_logging(self.config.params.get("log_level", "INFO"))
+        METRICS.configure(self.log_dir)
         self.rag = RAGManager(self.base_dir)
         self.engine = AIEngine(self.config)
+        self.model_path = ""
         self.load_ai_model()
 
+        # ★一度査読したページの結果を保存しておき、直していないページは即答します（pdf_cache_entries=0 で無効）
+        cache_entries = int(self.config.params.get("pdf_cache_entries", 5000))
+        self.pdf_cache = ResultCache(os.path.join(self.base_dir, "cache", "pdf_results.sqlite3"), cache_entries) if cache_entries > 0 else None
+
+        # ★よくある質問の回答を保存しておきます（answer_cache_entries=0 で無効、answer_cache_ttl 秒で期限切れ）
+        answer_entries = int(self.config.params.get("answer_cache_entries", 2000))
+        self.answer_cache = ResultCache(
+            os.path.join(self.base_dir, "cache", "answers.sqlite3"), answer_entries,
+            ttl=self.config.params.get("answer_cache_ttl", 24 * 3600)) if answer_entries > 0 else None
+
+        # ★AIに渡す前の簡易チェック（pdf_prescreen: off / skip / defer）
+        self.prescreen = PreScreen(os.path.join(self.base_dir, "typo_dict.txt"))
+
+        # ★査読の出力形式を決める文法（pdf_grammar を空にすると使いません）
+        self.proofread_grammar = None
+        grammar_file = self.config.params.get("pdf_grammar", "proofread.gbnf")
+        grammar_path = os.path.join(self.base_dir, grammar_file) if grammar_file else ""
+        if grammar_path and os.path.exists(grammar_path):
+            with open(grammar_path, "r", encoding="utf-8") as f: self.proofread_grammar = f.read()
+
+        # ★複数台で同じ exchange_box を分け合う時だけ fleet を true にします（受け取った依頼は clm_ に名前を変えて担当します）
+        #   1台で動かす時は今まで通りで、名前変更や hb_ ファイルの書き込みはしません
+        #   fleet_worker_id: 台ごとの名前（既定はコンピューター名）/ fleet_lease_seconds: 落ちた台の担当分を戻すまでの秒数
+        if self.config.params.get("fleet", False):
+            self.fleet = Fleet(self.box_dir, self.config.params.get("fleet_worker_id", ""),
+                               lease_seconds=float(self.config.params.get("fleet_lease_seconds", 120)))
+            self.fleet.start()
+            self.hosts = len(self.fleet.live_workers())
+
+        # ★受付の上限（queue_limits: レーンごとの順番待ちの上限件数、0で無制限）と、
+        #   Excel 側が待つ秒数（client_timeouts）。間に合わない見込みの依頼は処理せずにすぐ断ります
+        self.queue_limits = dict({"chat": 30, "pdf": 10}, **self.config.params.get("queue_limits", {}))
+        self.client_timeouts = dict({"chat": 120, "pdf": 300}, **self.config.params.get("client_timeouts", {}))
+
+        self.scheduler = self.build_scheduler()
+        self.register_gauges()
+
+        # ★HTTPの受付窓口（http_port を指定した時だけ。LANに公開する時は http_host を "0.0.0.0" に）
+        http_port = int(self.config.params.get("http_port", 0))
+        if http_port > 0:
+            try:
+                self.http = HttpChannel(self, self.config.params.get("http_host", "127.0.0.1"), http_port,
+                                        token=self.config.params.get("http_token", ""))
+                self.http.start()
+            except Exception as e:
+                print(f"⚠️ HTTP受付を開始できませんでした（exchange_box だけで動きます）: {e}")
+                self.http = None
+
     def load_ai_model(self):
         model_name = self.config.params.get("last_model", "")
         if not model_name:
@@ -47,16 +122,164 @@ class AIWatcher:
         
         if model_name:
             print(f"モデル準備完了: {model_name}")
-            self.engine.load_model(os.path.join(self.base_dir, "gguf", model_name))
+            path = os.path.join(self.base_dir, "gguf", model_name)
+            self.model_path = path
+            ok, _ = self.engine.load_model(path)
+            # embed_model の指定が無ければ、検索にも同じモデルを使います。
+            # ただしチャットのワーカーが複数の時は、他のワーカーの検索が1台目の生成の終わりを待たされるので共有しません
+            chat_workers = int(self.config.params.get("chat_workers", 1))
+            if ok and chat_workers > 1 and self.rag.shares_chat_model:
+                print(f"⚠️ chat_workers={chat_workers} のため、検索用にモデルを別に読み込みます（軽い embed_model の指定をおすすめします）")
+            elif ok:
+                self.rag.attach_model(self.engine.llm, path, self.engine.lock)
         else:
             print("警告: モデルが見つかりません。")
 
+    # =========================================================
+    # 🚦 レーン別ワーカー（chat / pdf）
+    # =========================================================
+    def build_scheduler(self):
+        """
+        chat_workers / pdf_workers（config.json）の数だけエンジンを用意します。
+        モデルの重みは mmap で共有されるので、1ワーカー増えるごとに主に増えるのはKVキャッシュ分(n_ctx)のメモリです。
+        """
+        chat_n = max(1, int(self.config.params.get("chat_workers", 1)))
+        pdf_n = max(1, int(self.config.params.get("pdf_workers", 1)))
+        engines = {
+            "chat": [self.engine] + [self.new_engine() for _ in range(chat_n - 1)],
+            "pdf": [self.new_engine() for _ in range(pdf_n)],
+        }
+        print(f"ワーカー: chat x{chat_n} / pdf x{pdf_n}")
+        # 実績が無い間の1件あたりの見込み時間（status.txt の待ち時間の表示に使います）
+        guess = {"chat": self.config.params.get("eta_guess_chat", 30), "pdf": self.config.params.get("eta_guess_pdf", 180)}
+        return RequestScheduler(engines, self.handle_request, guess)
+
+    def handle_request(self, engine, req):
+        """ワーカーが順番の来た依頼を受け取って処理します。他の台に先に取られていた時や、断った時、まだ空の時は False"""
+        lane = self.scheduler.stats()[req.lane]
+        timeout = float(self.client_timeouts.get(req.lane, 0) or 0)
+        waited = time.time() - req.enqueued_at
+        ewma = lane["service_ewma"]
+        # もう待ち時間の上限を過ぎたか、今から始めても上限までに終わらない見込みなら処理しません
+        if timeout and (waited >= timeout or (lane["done"] and ewma < timeout and waited + ewma > timeout)):
+            print(f"   🚫 {req.uid} は待ち時間の上限までに終わらない見込みのため断ります")
+            eta = self.scheduler.estimate(req.lane, self.hosts)[1]
+            if self.reject(req.path, req.lane, eta, "late"): self.scheduler.note_rejected(req.lane, shed=True)
+            return False
+        # 空の依頼は書き込み途中かもしれないので消さずに残し、次のスキャンで拾い直します（空のままなら cleanup_box が片付けます）
+        try: empty = os.path.getsize(req.path) == 0
+        except OSError: empty = False
+        if empty: return False
+        path = self.claim(req.path)
+        if path is None:
+            print(f"   🏭 {req.uid} は他の台が担当しました")
+            return False
+        try:
+            self.process_one_file(path, engine)
+        finally:
+            if self.fleet: self.fleet.release(path)
+        return True
+
+    def claim(self, req_path):
+        """複数台で動かす時は名前変更で担当を決めます（1台なら元のパスのまま）"""
+        if not self.fleet: return req_path
+        return self.fleet.claim(req_path)
+
+    # =========================================================
+    # 🚧 受付の制限（混雑時はすぐに res_ で断って、待ち時間の見込みを伝えます）
+    # =========================================================
+    def accept(self, req_path):
+        """依頼を順番待ちに積みます。混んでいる時は断って None を返します"""
+        if self.scheduler.is_known(req_path): return None
+        lane = "pdf" if req_path.lower().endswith(".pdf") else "chat"
+        limit = int(self.queue_limits.get(lane, 0) or 0)
+        timeout = float(self.client_timeouts.get(lane, 0) or 0)
+        queued, eta, ewma, measured = self.scheduler.estimate(lane, self.hosts)
+        # 件数の上限はいつでも、時間の見込みは実績があって、しかも待たされる時だけで判断します
+        if limit and queued >= limit: reason = "full"
+        elif timeout and measured and eta > ewma and eta > timeout: reason = "late"
+        else: return self.scheduler.submit(req_path)
+        print(f"\n🚧 [{lane}] 混雑のため受付を断りました（待ち{queued}件 見込み{eta:.0f}秒）: {os.path.basename(req_path)}")
+        if self.reject(req_path, lane, eta, reason, queued): self.scheduler.note_rejected(lane)
+        return None
+
+    def shed_late_requests(self):
+        """順番待ちのうち、Excel が待つ時間までに答えられない見込みの依頼を、処理する前に断ります"""
+        for lane, timeout in self.client_timeouts.items():
+            if not timeout: continue
+            for req in self.scheduler.shed(lane, float(timeout), self.hosts):
+                print(f"\n🚫 [{lane}] {req.uid} は待ち時間の上限までに終わらない見込みのため断ります")
+                eta = self.scheduler.estimate(lane, self.hosts)[1]
+                self.reject(req.path, lane, eta, "late")
+
+    def reject(self, req_path, lane, eta, reason, queued=0):
+        """依頼ファイルを片付けて、断りの返事を res_ に置きます（他の台が先に受け取っていたら何もしません）"""
+        path = self.claim(req_path)
+        if path is None: return False
+        unique_id = request_uid(path)
+        question = ""
+        if lane == "chat":
+            try:
+                with open(path, "r", encoding="cp932", errors="ignore") as f: question = f.read()
+            except: pass
+        try: os.remove(path)
+        except: pass
+        if self.fleet: self.fleet.release(path)
+
+        wait = f"約{int(eta // 60) + 1}分" if eta >= 60 else f"約{int(eta) + 1}秒"
+        kind = "質問" if lane == "chat" else "PDF査読"
+        if reason == "full":
+            text = (f"ただいま混み合っているため、この依頼は受け付けられませんでした。\n"
+                    f"（{kind}の順番待ち {queued}件・上限 {self.queue_limits.get(lane)}件）\n"
+                    f"今から送った場合の待ち時間の見込み: {wait}\n"
+                    f"少し時間をおいてから、もう一度送ってください。")
+        else:
+            text = (f"ただいま混み合っていて、待ち時間の上限（{int(self.client_timeouts.get(lane, 0))}秒）までに"
+                    f"回答できない見込みのため、処理を取りやめました。\n"
+                    f"今から送った場合の待ち時間の見込み: {wait}\n"
+                    f"少し時間をおいてから、もう一度送ってください。")
+        if question: self.save_history(unique_id, question, text, "混雑のため受付停止")
+        self.save_and_move_result(unique_id, text)
+        return True
+
+    def register_gauges(self):
+        """logs/metrics.json に書き出すたびに取り直す値（待ち件数とキャッシュのヒット率）"""
+        METRICS.gauge("queue_depth", lambda: {lane: st["queued"] for lane, st in self.scheduler.stats().items()})
+        METRICS.gauge("running", lambda: {lane: st["running"] for lane, st in self.scheduler.stats().items()})
+        METRICS.gauge("rejected", lambda: {lane: st["rejected"] for lane, st in self.scheduler.stats().items()})
+        METRICS.gauge("shed", lambda: {lane: st["shed"] for lane, st in self.scheduler.stats().items()})
+        METRICS.gauge("queue_wait_avg_seconds", lambda: {lane: round(st["wait_avg"], 3) for lane, st in self.scheduler.stats().items()})
+        if self.answer_cache: METRICS.gauge("answer_cache_hit_rate", lambda: self.answer_cache.stats()["hit_rate"])
+        if self.pdf_cache: METRICS.gauge("pdf_cache_hit_rate", lambda: self.pdf_cache.stats()["hit_rate"])
+        if self.engine.prefix_cache: METRICS.gauge("kv_prefix_cache_hit_rate", lambda: self.engine.cache_stats()["hit_rate"])
+        if self.fleet: METRICS.gauge("fleet_workers", lambda: self.hosts)
+        METRICS.gauge("db_generation", lambda: int(self.rag.db.generation.split("_")[-1]) if self.rag.db.generation else 0)
+
+    def review_pool(self, engine, procs):
+        """そのPDFワーカー用のプロセスプール。モデルやプロセス数が変わった時だけ作り直します"""
+        with self.review_pools_lock:
+            pool = self.review_pools.get(engine)
+            if pool is None or not pool.matches(self.model_path, procs):
+                if pool is not None: pool.close()
+                pool = ReviewPool(self.base_dir, self.model_path, procs, self.config.params.get("n_threads", 6))
+                self.review_pools[engine] = pool
+            return pool
+
+    def new_engine(self):
+        engine = AIEngine(self.config)
+        if self.model_path: engine.load_model(self.model_path)
+        return engine
+
     def cleanup_box(self, max_age_minutes=5):
         try:
             now = time.time()
             files = glob.glob(os.path.join(self.box_dir, "*_*.txt")) + glob.glob(os.path.join(self.box_dir, "req_*.pdf"))
             for f in files:
                 if "status.txt" in f: continue
+                # 担当中の依頼（clm_）と各台の生存確認（hb_）は、貸出期限の仕組みに任せます
+                if is_fleet_file(os.path.basename(f)): continue
+                # 順番待ち中の依頼は消しません
+                if self.scheduler and self.scheduler.is_known(f): continue
                 ctime = os.path.getctime(f)
                 if now - ctime > (max_age_minutes * 60):
                     try: os.remove(f)
@@ -66,7 +289,8 @@ class AIWatcher:
     # =========================================================
     # 📄 PDFファイルの査読（校正）処理
     # =========================================================
-    def process_pdf_file(self, pdf_path, unique_id):
+    def process_pdf_file(self, pdf_path, unique_id, engine=None):
+        engine = engine or self.engine
         print(f"\n📄 PDF査読開始 [{unique_id}]")
         full_report = f"【PDF査読結果】\n\n"
         
@@ -86,50 +310,125 @@ class AIWatcher:
         print("==========================================\n")
 
         model_name = self.config.params.get("last_model", "").lower()
+        grammar = self.proofread_grammar
         error_count = 0 # 指摘の数をカウントします
 
         try:
-            reader = PdfReader(pdf_path)
-            
-            for page_num, page in enumerate(reader.pages):
-                text = page.extract_text()
-                
-                if not text or not text.strip():
-                    continue # 空白ページはスキップ
+            # ★ページの取り出しは裏のスレッドで先読みし、生成と重ねて進めます
+            feeder = PageFeeder(pdf_path, queue_size=int(self.config.params.get("pdf_prefetch_pages", 4)),
+                                sys_msg=sys_msg, model_name=model_name)
 
-                print(f"   📖 第{page_num+1}ページ目をチェック中...", end="", flush=True)
-                
-                # ページ数をAIに伝えるための設定
-                question = f"【対象テキスト：第{page_num+1}ページ】\n{text.strip()}"
-                
-                # モデルに合わせたプロンプトの組み立て
-                if "gemma" in model_name:
-                    prompt = f"<start_of_turn>user\n{sys_msg}\n\n{question}<end_of_turn>\n<start_of_turn>model\n"
-                elif "elyza" in model_name or "llama-3" in model_name:
-                    prompt = f"<|start_header_id|>system<|end_header_id|>\n\n{sys_msg}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{question}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n"
-                else:
-                    prompt = f"{sys_msg}\n\nユーザー: {question}\nシステム:"
-
-                response = self.engine.generate(prompt)
-                
-                if isinstance(response, dict):
-                    response = response['choices'][0]['text']
-                if not response:
-                    response = "（エラー：生成失敗）"
-                
-                # ---------------------------------------------------------
-                # 「特になし」ならスルー、指摘があればリストに追加
-                # ---------------------------------------------------------
-                if "特になし" in response or response.strip() == "":
-                    print(" 問題なし")
-                else:
-                    full_report += f"{response.strip()}\n\n"
-                    error_count += 1
-                    print(" ⚠️指摘あり")
+            # キャッシュにあるページはここで抜き取り、AIには変わったページだけを渡します
+            cached = {}
+            page_keys = {}
+            pages = feeder
+            if self.pdf_cache:
+                model_id = model_fingerprint(self.model_path)
+
+                def uncached(items):
+                    for item in items:
+                        key = page_cache_key(item[1], model_id, sys_msg)
+                        hit = self.pdf_cache.get(key)
+                        if hit is not None:
+                            # 同じ文章が前回は別のページだったこともあるので、ページの印を今のページに直します
+                            cached[item[0]] = with_page(hit, item[0])
+                            continue
+                        page_keys[item[0]] = key
+                        yield item
+                pages = uncached(feeder)
+
+            # ★簡易チェックで怪しい所が無かったページは、省略(skip)するか最後に回します(defer)
+            prescreen_mode = self.config.params.get("pdf_prescreen", "off")
+            screened = {"clean": [], "flagged": 0}
+            if prescreen_mode in ("skip", "defer"):
+                def prescreened(items):
+                    for item in items:
+                        signals = self.prescreen.check(item[1])
+                        if signals:
+                            screened["flagged"] += 1
+                            print(f"   🔎 P.{item[0]}: " + ", ".join(f"{kind}({hit})" for kind, hit in signals[:3]))
+                            yield item
+                        else:
+                            screened["clean"].append(item)
+                    if prescreen_mode == "defer":
+                        yield from screened["clean"]
+                pages = prescreened(pages)
+
+            # ★pdf_pack_ratio（例: 0.5）を指定すると、短いページを n_ctx のその割合まで1回の呼び出しに詰め込みます
+            pack_ratio = float(self.config.params.get("pdf_pack_ratio", 0))
+            packs = None
+            if pack_ratio > 0:
+                budget = pack_budget(engine, sys_msg, pack_ratio)
+                packs = iter_packs(pages, engine.count_tokens, budget)
+                print(f"   📦 ページをまとめて査読します（1回あたり本文 {budget}トークンまで）")
+
+            # ★pdf_procs が2以上なら、ページ範囲ごとに別プロセスのAIで並行して査読します
+            procs = int(self.config.params.get("pdf_procs", 1))
+            calls = 0
+            if procs > 1 and self.model_path:
+                print(f"   🧵 {procs}プロセスで並列査読します")
+                results = review_pages_parallel(
+                    pages, sys_msg, model_name, self.review_pool(engine, procs),
+                    pages_per_task=int(self.config.params.get("pdf_pages_per_task", 2)),
+                    packs=packs, grammar=grammar,
+                )
+            elif packs is not None:
+                results = {}
+                for pack in packs:
+                    print(f"   📖 P.{pack[0][0]}～{pack[-1][0]}（{len(pack)}ページ）をチェック中...", end="", flush=True)
+                    pack_results = review_pack(engine, sys_msg, model_name, pack, grammar)
+                    results.update(pack_results)
+                    calls += 1
+                    print(" 問題なし" if all(is_clean(r) for r in pack_results.values()) else " ⚠️指摘あり")
+            else:
+                results = {}
+                for page_num, text, prompt, prefix in pages:
+                    print(f"   📖 第{page_num}ページ目をチェック中...", end="", flush=True)
+                    results[page_num] = generate_page(engine, prompt, prefix, grammar)
+                    calls += 1
+                    print(" 問題なし" if is_clean(results[page_num]) else " ⚠️指摘あり")
+            if calls: print(f"   🔢 {len(results)}ページを {calls}回の呼び出しで査読しました")
+
+            skipped = []
+            if prescreen_mode == "skip":
+                skipped = [item[0] for item in screened["clean"]]
+                for page_num in skipped: results[page_num] = "特になし"
+                print(f"   🔎 事前チェック: {screened['flagged']}ページに疑いあり / {len(skipped)}ページはAI査読を省略")
+            elif prescreen_mode == "defer":
+                print(f"   🔎 事前チェック: {screened['flagged']}ページを先に、{len(screened['clean'])}ページを後回しで査読")
+
+            if self.pdf_cache:
+                for page_num, key in page_keys.items():
+                    # 省略したページはAIの答えではないので保存しません
+                    if page_num in skipped: continue
+                    response = results.get(page_num)
+                    if response and response != FAILED_TEXT: self.pdf_cache.put(key, response)
+                results.update(cached)
+                st = self.pdf_cache.stats()
+                print(f"   💾 キャッシュから {len(cached)}/{len(results)}ページを再利用（通算ヒット率 {st['hit_rate']:.0%}, {st['entries']}件保存）")
+            print(f"   ⏱ {feeder.summary()}")
+            METRICS.observe("pdf_extract", feeder.extract_seconds)
+            METRICS.observe("pdf_extract_wait", feeder.wait_seconds)
+            METRICS.count("pdf_pages", feeder.pages)
+            METRICS.count("pdf_calls", calls)
+            METRICS.count("pdf_cache_hits", len(cached))
+            METRICS.count("pdf_prescreen_skipped", len(skipped))
+
+            # ---------------------------------------------------------
+            # ページ順に並べて、指摘が無ければスルー、指摘があればリストに追加
+            # ---------------------------------------------------------
+            for page_num in sorted(results):
+                response = results[page_num]
+                if is_clean(response):
+                    continue
+                full_report += f"{report_text(response)}\n\n"
+                error_count += 1
             
             # 全部のページが完璧だった場合
             if error_count == 0:
                 full_report += "指摘する箇所はありませんでした。素晴らしい文章です！\n"
+            if skipped:
+                full_report += f"\n（事前チェックで怪しい箇所が無かった {len(skipped)}ページは、AIの査読を省略しました：P.{', P.'.join(map(str, skipped))}）\n"
             
             # 終わったPDFは削除します
             try:
@@ -145,17 +444,119 @@ class AIWatcher:
 
         self.save_and_move_result(unique_id, full_report)
 
+    # =========================================================
+    # 💬 同じ質問の見分け方
+    # =========================================================
+    @staticmethod
+    def normalize_question(question):
+        """全角半角・空白・大文字小文字・文末の「？」「。」の違いだけなら同じ質問として扱います"""
+        text = " ".join(unicodedata.normalize("NFKC", question).lower().split())
+        return text.rstrip("?。.!！ ")
+
+    def answer_key(self, question, sys_msg):
+        # 知識DBの世代・モデル・指示書のどれかが変われば、別の質問として扱います
+        return make_key("answer", self.normalize_question(question), self.rag.db.generation,
+                        model_fingerprint(self.model_path), make_key(sys_msg))
+
+    def take_same_questions(self, question):
+        """順番待ちのチャット依頼から同じ質問を抜き取り、[(Request, 質問文), ...] を返します"""
+        if not self.scheduler: return []
+        target = self.normalize_question(question)
+        same = {}
+        for req in self.scheduler.queued("chat"):
+            if req.ext != ".txt": continue
+            try:
+                with open(req.path, "r", encoding="cp932", errors="ignore") as f: text = f.read()
+            except: continue
+            if text and self.normalize_question(text) == target: same[req.path] = text
+
+        taken = []
+        for req in self.scheduler.take("chat", same):
+            # 他の台が先に受け取った質問は、そちらで答えます
+            path = self.claim(req.path)
+            if path is None:
+                self.scheduler.complete(req, counted=False)
+                continue
+            try: os.remove(path)
+            except: pass
+            if self.fleet: self.fleet.release(path)
+            taken.append((req, same[req.path]))
+        return taken
+
+    # =========================================================
+    # 🔍 順番待ちの質問の検索を先に済ませる
+    #   先頭の依頼を生成している間に、残りの質問をまとめて1回でベクトル化・検索しておきます
+    # =========================================================
+    def start_prefetch(self):
+        if not self.scheduler or not self.config.params.get("rag_prefetch", True): return
+        # チャット用のモデルでベクトル化している時は、先読みも回答の生成が終わるまで待たされ、
+        # その間 embed_lock を持ったままになるので、次の依頼の検索をかえって遅らせます
+        if self.rag.embeds_on_chat_engine: return
+        with self.prefetch_lock:
+            if self.prefetching: return
+            self.prefetching = True
+        threading.Thread(target=self.prefetch_contexts, daemon=True).start()
+
+    def prefetch_contexts(self):
+        trace = METRICS.start("prefetch")
+        try:
+            # 答え終わった依頼（まとめて回答・お掃除で消えた分も）の結果は捨てます
+            with self.prefetch_lock:
+                for path in [p for p in self.prefetched if not self.scheduler.is_known(p)]:
+                    del self.prefetched[path]
+
+            generation = self.rag.db.generation
+            paths = []
+            questions = []
+            for req in self.scheduler.queued("chat"):
+                if req.ext != ".txt": continue
+                with self.prefetch_lock:
+                    hit = self.prefetched.get(req.path)
+                if hit and hit[0] == generation: continue
+                try:
+                    with open(req.path, "r", encoding="cp932", errors="ignore") as f: text = f.read()
+                except: continue
+                if not text: continue
+                paths.append(req.path)
+                questions.append(text)
+            if not questions: return
+
+            t_start = time.perf_counter()
+            contexts = self.rag.get_contexts(questions)
+            with self.prefetch_lock:
+                for path, question, (ctx, files) in zip(paths, questions, contexts):
+                    self.prefetched[path] = (generation, question, ctx, files)
+            print(f"   🔍 順番待ち {len(questions)}件の検索を先に済ませました（{time.perf_counter() - t_start:.2f}秒）")
+        except Exception as e:
+            print(f"先読み検索エラー: {e}")
+        finally:
+            with self.prefetch_lock:
+                self.prefetching = False
+            if trace.stages: METRICS.finish(trace)
+
+    def lookup_context(self, req_path, question):
+        """先に済ませた検索結果があれば使い、無ければ（DBが入れ替わった時も）ここで検索します"""
+        with self.prefetch_lock:
+            hit = self.prefetched.pop(req_path, None)
+        if hit and hit[0] == self.rag.db.generation and hit[1] == question:
+            print("   🔍 先読みした検索結果を使います")
+            METRICS.count("prefetch_hits")
+            return hit[2], hit[3]
+        with METRICS.stage("retrieve"):
+            return self.rag.get_context(question)
+
     # =========================================================
     # 📝 通常のテキストファイル（RAGチャット）処理
     # =========================================================
-    def process_one_file(self, req_path):
+    def process_one_file(self, req_path, engine=None):
+        engine = engine or self.engine
         filename = os.path.basename(req_path)
-        unique_id = filename.replace("req_", "").replace(".txt", "").replace(".pdf", "")
+        unique_id = request_uid(filename)
         ext = os.path.splitext(filename)[1].lower()
 
         # PDFなら査読処理へ分岐
         if ext == ".pdf":
-            self.process_pdf_file(req_path, unique_id)
+            self.process_pdf_file(req_path, unique_id, engine)
             return
 
         question = ""
@@ -173,35 +574,71 @@ class AIWatcher:
         try: os.remove(req_path)
         except: pass
 
-        ctx, files = self.rag.get_context(question)
-        rag_text = f"以下の情報を元に回答。\n{ctx}" if files else "親切に回答してください。"
-        
         sys_msg = self.config.get_system_prompt("normal")
         model_name = self.config.params.get("last_model", "").lower()
+
+        # ★同じ質問への回答が保存されていれば、検索も生成もせずに返します
+        answer_key = self.answer_key(question, sys_msg)
+        if self.answer_cache:
+            cached = self.answer_cache.get(answer_key)
+            if cached is not None:
+                print("   💾 保存済みの回答を返しました")
+                METRICS.count("answer_cache_hits")
+                METRICS.tag("answer_cache")
+                self.save_history(unique_id, question, cached, "キャッシュ")
+                self.save_and_move_result(unique_id, cached)
+                return
+
+        # ★順番待ちの中に同じ質問があれば、1回の生成でまとめて答えます
+        followers = self.take_same_questions(question)
+        if followers:
+            print(f"   🤝 同じ質問 {len(followers)}件をまとめて回答します")
+            METRICS.count("coalesced", len(followers))
+
+        # 先読みは受付時の名前（req_）で覚えています
+        ctx, files = self.lookup_context(os.path.join(self.box_dir, f"req_{unique_id}{ext}"), question)
+        rag_text = f"以下の情報を元に回答。\n{ctx}" if files else "親切に回答してください。"
+        # 自分の生成中に、後ろで待っている質問の検索を進めておきます
+        self.start_prefetch()
         
+        # prefix は毎回共通のシステムプロンプト部分（KVキャッシュで再利用）
         if "gemma" in model_name:
-            prompt = f"<start_of_turn>user\n{sys_msg}\n\n{rag_text}\n\n【質問】\n{question}<end_of_turn>\n<start_of_turn>model\n"
+            prefix = f"<start_of_turn>user\n{sys_msg}\n\n"
+            prompt = f"{prefix}{rag_text}\n\n【質問】\n{question}<end_of_turn>\n<start_of_turn>model\n"
         elif "elyza" in model_name or "llama-3" in model_name:
-            prompt = f"<|start_header_id|>system<|end_header_id|>\n\n{sys_msg}\n{rag_text}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{question}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n"
+            prefix = f"<|start_header_id|>system<|end_header_id|>\n\n{sys_msg}\n"
+            prompt = f"{prefix}{rag_text}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{question}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n"
         else:
-            prompt = f"{sys_msg}\n\n{rag_text}\n\nユーザー: {question}\nシステム:"
+            prefix = f"{sys_msg}\n\n"
+            prompt = f"{prefix}{rag_text}\n\nユーザー: {question}\nシステム:"
 
         print(f"   ✍️ 回答生成中...", end="", flush=True)
-        full_response = self.engine.generate(prompt)
+        # HTTPで待っている人には、書いた分から少しずつ届けます
+        parts = []
+        for delta in engine.generate_stream(prompt, prefix=prefix):
+            parts.append(delta)
+            if self.http: self.http.hub.push(unique_id, delta)
+        full_response = "".join(parts) or None
         
-        if isinstance(full_response, dict):
-             full_response = full_response['choices'][0]['text']
         if not full_response: 
             full_response = "（エラー：回答の生成に失敗しました）"
+        elif self.answer_cache and not engine.last_stats.get("stopped"):
+            self.answer_cache.put(answer_key, full_response)
         
         print(" 完了")
         self.save_history(unique_id, question, full_response)
         self.save_and_move_result(unique_id, full_response)
+        for req, text in followers:
+            self.save_history(req.uid, text, full_response, "まとめて回答")
+            self.save_and_move_result(req.uid, full_response)
+            self.scheduler.complete(req)
 
     # =========================================================
     # 💾 保存や記録の共通処理
     # =========================================================
     def save_and_move_result(self, unique_id, text):
+        # HTTPから来た依頼は、待っている接続にそのまま返します
+        if self.http and self.http.hub.deliver(unique_id, text): return
         final_path = os.path.join(self.box_dir, f"res_{unique_id}.txt")
         temp_path = os.path.join(self.box_dir, f"tmp_{unique_id}.txt")
         try:
@@ -212,16 +649,59 @@ class AIWatcher:
             print(f"保存エラー: {e}")
             if os.path.exists(temp_path): os.remove(temp_path)
 
-    def save_history(self, uid, question, answer):
+    def save_history(self, uid, question, answer, note=""):
+        """note: 「キャッシュ」「まとめて回答」など、AIが生成していない行の目印"""
         try:
             now_str = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-            with open(self.log_file, "a", encoding="cp932", errors="replace", newline="") as f:
+            with self.history_lock, open(self.log_file, "a", encoding="cp932", errors="replace", newline="") as f:
                 writer = csv.writer(f)
                 clean_q = question.replace("\n", " ").replace("\r", "")
                 clean_a = answer.replace("\n", " ").replace("\r", "")
-                writer.writerow([now_str, uid, clean_q, clean_a])
+                writer.writerow([now_str, uid, clean_q, clean_a, note])
         except: pass
 
+    # =========================================================
+    # 🚥 status.txt（Excel が順番と待ち時間を知るための小さなファイル）
+    #   1行目は従来どおり「日時 - READY」。2行目以降は「名前=値」の形です
+    #     queue=全体の待ち件数 / queue_chat= / queue_pdf=
+    #     processing=処理中の依頼ID（複数ならカンマ区切り）
+    #     eta_chat= / eta_pdf=  今から送った場合の回答までの見込み秒数
+    #     q=依頼ID,レーン内の順番,回答までの見込み秒数   ← 待っている依頼1件につき1行
+    #   Excel は共有フォルダの一覧を取らずに、このファイル1つを読むだけで済みます
+    # =========================================================
+    def write_status(self, status_file):
+        # 複数台の時は1台だけが書きます（後から書いた台の内容で上書きし合わないように）
+        if self.fleet and not self.publishes_status: return
+        now = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        status = self.scheduler.status(self.hosts)
+        busy = any(lane["processing"] for lane in status.values())
+        lines = [
+            f"{now} - READY",
+            f"updated={now}",
+            f"state={'BUSY' if busy else 'IDLE'}",
+            f"queue={sum(len(lane['queued']) for lane in status.values())}",
+        ]
+        processing = []
+        for name, lane in status.items():
+            lines.append(f"queue_{name}={len(lane['queued'])}")
+            lines.append(f"workers_{name}={lane['workers']}")
+            lines.append(f"eta_{name}={int(lane['next_eta'])}")
+            processing += [p[0] for p in lane["processing"]]
+        # 複数台の時は、どの台が処理中の依頼も載せます（担当中の clm_ ファイルから分かります）
+        if self.fleet: processing = sorted(set(processing) | set(self.fleet.claimed_uids()))
+        lines.append(f"processing={','.join(processing)}")
+        if self.fleet: lines.append(f"hosts={self.hosts}")
+        for name, lane in status.items():
+            for uid, pos, eta in lane["queued"]:
+                lines.append(f"q={uid},{pos},{int(eta)}")
+
+        # 書きかけを読まれないよう、一時ファイルに書いてから置き換えます（一時ファイルは台・プロセスごとに別の名前）
+        owner = f"{self.fleet.worker_id}." if self.fleet else ""
+        tmp = f"{status_file}.{owner}{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="cp932", errors="replace") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, status_file)
+
     # =========================================================
     # メインループ
     # =========================================================
@@ -230,36 +710,93 @@ class AIWatcher:
         status_file = os.path.join(self.box_dir, "status.txt")
         last_heartbeat = 0
         last_cleanup = 0 
+        last_db_check = 0
+        last_scan = 0
+        status_version = -1
+        last_export = 0
+        last_reclaim = 0
+
+        # ★ファイルが置かれた瞬間に起きる変更通知（使えない環境ではポーリング）
+        box_watch = make_box_watcher(
+            self.box_dir,
+            self.config.params.get("watch_backend", "auto"),
+            poll_interval=self.config.params.get("poll_interval", 0.25),
+            rescan_interval=self.config.params.get("rescan_interval", 10.0),
+        )
+        print(f"監視方式: {box_watch.name}")
+        settle = ReadyFilter()
+        changed = True
         
         while True:
             try:
                 now = time.time()
-                # 5秒に1回の「生きてるよ！」の合図
-                if now - last_heartbeat > 5.0:
+                # 5秒に1回の「生きてるよ！」の合図（待ち行列が変わった時はすぐ書き直します）
+                if now - last_heartbeat > 5.0 or self.scheduler.version != status_version:
                     try:
-                        with open(status_file, "w", encoding="cp932") as f:
-                            f.write(datetime.now().strftime("%Y/%m/%d %H:%M:%S") + " - READY")
+                        status_version = self.scheduler.version
+                        self.write_status(status_file)
                         last_heartbeat = now
-                    except: pass
+                    except Exception as e: print(f"status.txt 書き込みエラー: {e}")
+                # 処理時間などの集計を logs/metrics.json / metrics.prom に書き出します
+                if now - last_export > 5.0:
+                    METRICS.export()
+                    last_export = now
                 
                 # 60秒に1回のポストのお掃除
                 if now - last_cleanup > 60.0:
                     self.cleanup_box(max_age_minutes=5)
                     last_cleanup = now
+                    # レーンごとの待ち時間（キューに積まれてから処理が始まるまで）
+                    for lane, st in self.scheduler.stats().items():
+                        if st["done"] or st["queued"] or st["rejected"] or st["shed"]:
+                            print(f"📊 [{lane}] 完了{st['done']}件 待ち{st['queued']}件 平均待ち{st['wait_avg']:.1f}秒 最大待ち{st['wait_max']:.1f}秒 断った{st['rejected'] + st['shed']}件")
 
-                # txt と pdf の両方を探します
-                req_files = glob.glob(os.path.join(self.box_dir, "req_*.txt")) + glob.glob(os.path.join(self.box_dir, "req_*.pdf"))
-                req_files.sort(key=os.path.getctime)
-                
-                for req_path in req_files:
-                    self.process_one_file(req_path)
-                    time.sleep(0.1)
+                # GUIなどで知識DBが更新されていたら、裏で読み込んで差し替えます（再起動不要）
+                if now - last_db_check > 5.0:
+                    self.rag.reload_if_changed()
+                    last_db_check = now
+
+                # txt と pdf の両方を探します（通知が来た時と、念のための定期再スキャン時だけ）
+                if changed or now - last_scan >= box_watch.rescan_interval:
+                    last_scan = now
+                    # 受け付けるだけで、処理はレーンごとのワーカーが並行して行います
+                    stats = {}
+                    found = scan_requests(self.box_dir, stats)
+                    # 空のまま・書き込み途中の依頼は、大きさが落ち着くまで受け付けません
+                    for req_path in settle.ready(found, stats):
+                        # HTTPの依頼は、待っている接続がある台（受け付けた台）だけが処理します
+                        name = os.path.basename(req_path)
+                        if name.startswith("req_http_") and not (self.http and self.http.hub.is_registered(request_uid(name))): continue
+                        self.accept(req_path)
+                    # 他の台が受け取った（消えた）依頼は、順番待ちから外します
+                    if self.fleet: self.scheduler.retain(found)
+
+                # 間に合わない見込みになった順番待ちは、待たせずに断ります
+                self.shed_late_requests()
+
+                # 落ちた台が持ったままの依頼を受付に戻します（戻した分はすぐ次のスキャンで拾います）
+                if self.fleet and now - last_reclaim > 10.0:
+                    last_reclaim = now
+                    if self.fleet.reclaim_expired(): last_scan = 0
+                    alive = self.fleet.live_workers()
+                    self.hosts = len(alive)
+                    self.publishes_status = self.fleet.is_publisher(alive)
+                    self.fleet.info = "\n".join(f"{lane}: 処理中{st['running']}件 待ち{st['queued']}件" for lane, st in self.scheduler.stats().items())
                 
-                time.sleep(1.0)
+                # 次の通知まで待ちます（心拍を止めないよう最長1秒）
+                # 書き込み途中の依頼がある時は、通知を待たずにすぐ確かめ直します
+                changed = box_watch.wait(SETTLE_INTERVAL if settle.pending else 1.0) or settle.pending
                 
             except KeyboardInterrupt:
                 print("\n終了します。")
-                if os.path.exists(status_file):
+                box_watch.close()
+                self.scheduler.stop()
+                if self.http: self.http.stop()
+                # 他に生きている台があれば、status.txt はその台に任せて消しません
+                others = [w for w in self.fleet.live_workers() if w != self.fleet.worker_id] if self.fleet else []
+                if self.fleet: self.fleet.stop()
+                for pool in self.review_pools.values(): pool.close()
+                if not others and os.path.exists(status_file):
                     try: os.remove(status_file)
                     except: pass
                 break
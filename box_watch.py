@@ -0,0 +1,310 @@
+import os
+import sys
+import time
+import threading
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# =========================================================
+# 📮 exchange_box の変更監視
+#   inotify  : Linux。ファイルが書き終わった瞬間(close_write)に起きます
+#              ただし CIFS/NFS などのネットワークのマウントでは、他のPCからの書き込みは通知されません
+#   windows  : ReadDirectoryChangesW。Windowsの共有フォルダ(SMB)でも通知が届きます
+#   polling  : os.scandir で一覧を取るだけの予備。通知が届かないNAS等ではこちら
+# どの方式でも wait() から戻ったら scan_requests() で一覧を取り直します
+# 書き込み途中のファイルは ReadyFilter で外し、大きさが落ち着いてから受け付けます
+# =========================================================
+
+REQ_EXTS = (".txt", ".pdf")
+
+# 書き込み途中かもしれないファイルがある時に、次に確かめるまでの秒数
+SETTLE_INTERVAL = 0.2
+
+# 他のPCからの書き込みを inotify で受け取れないファイルシステム
+NETWORK_FS = ("cifs", "smb3", "smbfs", "nfs", "nfs4", "afs", "9p", "fuse.sshfs", "davfs", "fuse.rclone")
+
+
+def is_network_fs(path):
+    """Linux で path がネットワークのマウント上にあるか（/proc/mounts で一番長く一致するマウント先の種類）"""
+    try:
+        real = os.path.realpath(path)
+        best, fstype = "", ""
+        with open("/proc/mounts", "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 3: continue
+                mount = parts[1].replace("\\040", " ")
+                if (real == mount or real.startswith(mount.rstrip("/") + "/")) and len(mount) >= len(best):
+                    best, fstype = mount, parts[2]
+        return fstype in NETWORK_FS
+    except OSError:
+        return False
+
+
+def scan_requests(box_dir, stats=None):
+    """
+    req_*.txt / req_*.pdf を作成時刻順に返します（フォルダ一覧は1回だけ）
+    stats に辞書を渡すと {パス: (大きさ, 更新時刻)} も入れて返します（ReadyFilter 用）
+    """
+    found = []
+    try:
+        with os.scandir(box_dir) as it:
+            for entry in it:
+                name = entry.name
+                if not name.startswith("req_") or not name.lower().endswith(REQ_EXTS): continue
+                try: st = entry.stat()
+                except OSError: continue
+                found.append((st.st_ctime, entry.path))
+                if stats is not None: stats[entry.path] = (st.st_size, st.st_mtime_ns)
+    except OSError:
+        return []
+    found.sort()
+    return [path for _, path in found]
+
+
+class ReadyFilter:
+    """
+    書き込み途中の依頼を外します。
+    VBA の Open ... For Output や FileCopy は、まず空のファイルを作ってから中身を書くので、
+    Windows の変更通知(作成時)や一覧のタイミングによっては、空や途中までのファイルが見えます。
+    大きさが0でなく、前回のスキャンから大きさも更新時刻も変わっていないファイルだけを「置き終わった」とみなします。
+    """
+
+    def __init__(self):
+        self._seen = {}
+        # 前回のスキャンで新しく見えたか、大きさが変わっていたファイルがあるか（すぐ確かめ直す目安）
+        self.pending = False
+
+    def ready(self, found, stats):
+        """found のうち置き終わったものを返します"""
+        ready, seen, pending = [], {}, False
+        for path in found:
+            sig = stats.get(path)
+            if sig is None: continue
+            seen[path] = sig
+            if self._seen.get(path) != sig: pending = True
+            elif sig[0] > 0: ready.append(path)
+        self._seen = seen
+        self.pending = pending
+        return ready
+
+class PollingWatcher:
+    name = "polling"
+
+    def __init__(self, box_dir, interval=0.25):
+        self.box_dir = box_dir
+        self.interval = interval
+        # 毎回一覧を取るので、念のための再スキャンは不要です
+        self.rescan_interval = 0.0
+
+    def wait(self, timeout):
+        time.sleep(min(self.interval, timeout))
+        return True
+
+    def close(self): pass
+
+
+class InotifyWatcher:
+    name = "inotify"
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_NONBLOCK = 0o4000
+
+    def __init__(self, box_dir, rescan_interval=10.0):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK)
+        if self.fd < 0: raise OSError(ctypes.get_errno(), "inotify_init1")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(box_dir), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch")
+        self.box_dir = box_dir
+        # ネットワーク越しの書き込みは通知されないことがあるので、時々は一覧も取り直します
+        self.rescan_interval = rescan_interval
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return False
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if not ready: return False
+            if self._drain(): return True
+
+    def _drain(self):
+        """溜まったイベントを読み捨て、req_ ファイルのものがあったか返します（status.txt 等の書き込みは無視）"""
+        hit = False
+        try:
+            while True:
+                data = os.read(self.fd, 65536)
+                if not data: break
+                pos = 0
+                while pos + 16 <= len(data):
+                    _, _, _, length = struct.unpack_from("iIII", data, pos)
+                    name = data[pos + 16:pos + 16 + length].rstrip(b"\0")
+                    if name.startswith(b"req_"): hit = True
+                    pos += 16 + length
+        except BlockingIOError:
+            pass
+        return hit
+
+    def close(self):
+        try: os.close(self.fd)
+        except OSError: pass
+
+
+class WindowsWatcher:
+    """
+    ReadDirectoryChangesW を裏のスレッドで待ち、変わったファイルの名前が req_ の時だけ起こします。
+    status.txt や hb_*.txt の書き直しでは起きないので、共有フォルダの一覧を無駄に取りません。
+    """
+    name = "windows"
+    FILE_LIST_DIRECTORY = 0x0001
+    FILE_SHARE_ALL = 0x00000007
+    OPEN_EXISTING = 3
+    FILE_FLAG_BACKUP_SEMANTICS = 0x02000000
+    FILE_NOTIFY_CHANGE_FILE_NAME = 0x00000001
+    FILE_NOTIFY_CHANGE_LAST_WRITE = 0x00000010
+    INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+
+    def __init__(self, box_dir, rescan_interval=10.0):
+        from ctypes import wintypes
+        self.kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        self.kernel32.CreateFileW.restype = ctypes.c_void_p
+        self.kernel32.ReadDirectoryChangesW.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, wintypes.DWORD, wintypes.BOOL, wintypes.DWORD,
+            ctypes.POINTER(wintypes.DWORD), ctypes.c_void_p, ctypes.c_void_p]
+        self.kernel32.CancelIoEx.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        self.kernel32.CloseHandle.argtypes = [ctypes.c_void_p]
+        self.handle = self.kernel32.CreateFileW(
+            box_dir, self.FILE_LIST_DIRECTORY, self.FILE_SHARE_ALL, None,
+            self.OPEN_EXISTING, self.FILE_FLAG_BACKUP_SEMANTICS, None)
+        if not self.handle or self.handle == self.INVALID_HANDLE_VALUE:
+            raise OSError(ctypes.get_last_error(), "CreateFileW")
+        self.box_dir = box_dir
+        self.rescan_interval = rescan_interval
+        self._event = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._read_loop, daemon=True)
+        self._thread.start()
+
+    def _read_loop(self):
+        from ctypes import wintypes
+        # ネットワーク越しの監視は 64KB までしか受け取れません
+        buf = ctypes.create_string_buffer(64 * 1024)
+        returned = wintypes.DWORD()
+        while not self._closed:
+            ok = self.kernel32.ReadDirectoryChangesW(
+                self.handle, buf, len(buf), False,
+                self.FILE_NOTIFY_CHANGE_FILE_NAME | self.FILE_NOTIFY_CHANGE_LAST_WRITE,
+                ctypes.byref(returned), None, None)
+            if not ok or self._closed: break
+            # 0バイトはバッファがあふれた印なので、念のため一覧を取り直します
+            if returned.value == 0 or self._has_request(buf.raw[:returned.value]): self._event.set()
+
+    @staticmethod
+    def _has_request(data):
+        """FILE_NOTIFY_INFORMATION の並びから、req_ で始まる名前があるか調べます"""
+        pos = 0
+        while pos + 12 <= len(data):
+            next_offset, _, length = struct.unpack_from("<III", data, pos)
+            name = data[pos + 12:pos + 12 + length].decode("utf-16-le", errors="replace")
+            if name.startswith("req_"): return True
+            if next_offset == 0: break
+            pos += next_offset
+        return False
+
+    def wait(self, timeout):
+        if not self._thread.is_alive():
+            # 監視が止まったら、以後は1秒ごとのポーリングと同じに毎回スキャンさせます
+            time.sleep(min(1.0, timeout))
+            return True
+        if not self._event.wait(timeout): return False
+        self._event.clear()
+        return True
+
+    def close(self):
+        self._closed = True
+        self.kernel32.CancelIoEx(self.handle, None)
+        self.kernel32.CloseHandle(self.handle)
+
+
+def make_box_watcher(box_dir, backend="auto", poll_interval=0.25, rescan_interval=10.0):
+    """backend: auto / inotify / windows / polling。使えない方式を指定した時は polling にします"""
+    if backend == "auto":
+        backend = "windows" if sys.platform == "win32" else "inotify" if sys.platform.startswith("linux") else "polling"
+        if backend == "inotify" and is_network_fs(box_dir):
+            # 他のPCが置いた依頼は通知されないので、従来どおり一覧を取ります（間隔は最短1秒）
+            print("ネットワークのフォルダなので、ポーリングで監視します")
+            return PollingWatcher(box_dir, max(poll_interval, 1.0))
+    try:
+        if backend == "inotify": return InotifyWatcher(box_dir, rescan_interval)
+        if backend == "windows": return WindowsWatcher(box_dir, rescan_interval)
+    except Exception as e:
+        print(f"⚠️ 変更通知({backend})が使えないため、ポーリングで監視します: {e}")
+    return PollingWatcher(box_dir, poll_interval)
+
+
+# =========================================================
+# 🧪 受付までの遅延を計るベンチマーク
+#   python box_watch.py bench [フォルダ] [回数]
+# =========================================================
+def _bench_backend(watcher, box_dir, count):
+    import threading
+    import statistics
+
+    written = {}
+    latencies = []
+    done = threading.Event()
+
+    def consumer():
+        last_scan = 0.0
+        settle = ReadyFilter()
+        while not done.is_set():
+            changed = watcher.wait(SETTLE_INTERVAL if settle.pending else 0.5)
+            if settle.pending: changed = True
+            now = time.perf_counter()
+            if not changed and now - last_scan < watcher.rescan_interval: continue
+            last_scan = now
+            stats = {}
+            found = scan_requests(box_dir, stats)
+            for path in settle.ready(found, stats):
+                t = written.pop(path, None)
+                if t is None: continue
+                latencies.append(time.perf_counter() - t)
+                try: os.remove(path)
+                except OSError: pass
+
+    th = threading.Thread(target=consumer, daemon=True)
+    th.start()
+    for i in range(count):
+        path = os.path.join(box_dir, f"req_bench_{watcher.name}_{i}.txt")
+        # 書き込み完了より先に時刻を記録しておかないと、通知の方が早く届いて取りこぼします
+        written[path] = time.perf_counter()
+        with open(path, "w", encoding="cp932") as f: f.write("bench")
+        time.sleep(0.3)
+    time.sleep(1.0)
+    done.set()
+    th.join()
+    watcher.close()
+
+    if not latencies:
+        print(f"{watcher.name:<8} 検出できませんでした")
+        return
+    latencies.sort()
+    ms = [v * 1000 for v in latencies]
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    print(f"{watcher.name:<8} n={len(ms):<4} 平均 {statistics.mean(ms):7.1f}ms  中央値 {statistics.median(ms):7.1f}ms  p95 {p95:7.1f}ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        import tempfile
+        box_dir = sys.argv[2] if len(sys.argv) >= 3 and sys.argv[2] else tempfile.mkdtemp()
+        count = int(sys.argv[3]) if len(sys.argv) >= 4 else 20
+        print(f"受付遅延ベンチマーク: {box_dir}")
+        _bench_backend(make_box_watcher(box_dir, "auto"), box_dir, count)
+        _bench_backend(PollingWatcher(box_dir, 0.25), box_dir, count)
+        _bench_backend(PollingWatcher(box_dir, 1.0), box_dir, count)
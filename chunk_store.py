@@ -0,0 +1,105 @@
+import os
+import json
+import mmap
+import numpy as np
+
+# チャンク1件ぶんの位置情報（id の昇順に並べて保存します）
+INDEX_DTYPE = np.dtype([("id", "<i8"), ("offset", "<i8"), ("length", "<i4"), ("file_id", "<i4")])
+
+BLOB_NAME = "chunks.bin"
+INDEX_NAME = "chunks_idx.npy"
+FILES_NAME = "chunks_files.json"
+
+
+class ChunkStore:
+    """
+    チャンク本文を1つのUTF-8ファイル(chunks.bin)にまとめ、位置と出典ファイルを配列で持つ保存形式。
+    mmap で開くので起動時に全文を読み込まず、検索でヒットしたチャンクだけを読みます。
+    """
+
+    def __init__(self, index, files, blob=None, blob_file=None):
+        self.index = index      # INDEX_DTYPE の配列（mmap）
+        self.files = files      # file_id -> ファイル名
+        self._blob = blob
+        self._blob_file = blob_file
+
+    # ----------------------------------------------------------------
+    # 書き込み・読み込み
+    # ----------------------------------------------------------------
+    @staticmethod
+    def write(dir_path, records):
+        """records: (id, テキスト, ファイル名) の並び"""
+        records = sorted(records, key=lambda r: r[0])
+        files = []
+        file_ids = {}
+        index = np.zeros(len(records), dtype=INDEX_DTYPE)
+
+        offset = 0
+        with open(os.path.join(dir_path, BLOB_NAME), "wb") as f:
+            for i, (chunk_id, text, filename) in enumerate(records):
+                data = text.encode("utf-8")
+                f.write(data)
+                if filename not in file_ids:
+                    file_ids[filename] = len(files)
+                    files.append(filename)
+                index[i] = (chunk_id, offset, len(data), file_ids[filename])
+                offset += len(data)
+
+        with open(os.path.join(dir_path, INDEX_NAME), "wb") as f:
+            np.save(f, index)
+        with open(os.path.join(dir_path, FILES_NAME), "w", encoding="utf-8") as f:
+            json.dump(files, f, ensure_ascii=False)
+
+    @staticmethod
+    def exists(dir_path):
+        return all(os.path.exists(os.path.join(dir_path, n)) for n in (BLOB_NAME, INDEX_NAME, FILES_NAME))
+
+    @classmethod
+    def open(cls, dir_path):
+        index = np.load(os.path.join(dir_path, INDEX_NAME), mmap_mode="r")
+        with open(os.path.join(dir_path, FILES_NAME), "r", encoding="utf-8") as f:
+            files = json.load(f)
+
+        blob_file = open(os.path.join(dir_path, BLOB_NAME), "rb")
+        if os.fstat(blob_file.fileno()).st_size == 0:
+            # 長さ0のファイルは mmap できないので空のまま扱います
+            return cls(index, files, b"", blob_file)
+        blob = mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(index, files, blob, blob_file)
+
+    # ----------------------------------------------------------------
+    # 参照
+    # ----------------------------------------------------------------
+    def _pos(self, chunk_id):
+        ids = self.index["id"]
+        pos = int(np.searchsorted(ids, chunk_id))
+        if pos < len(ids) and ids[pos] == chunk_id: return pos
+        return -1
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, chunk_id):
+        return self._pos(chunk_id) >= 0
+
+    def ids(self):
+        return np.asarray(self.index["id"])
+
+    def get(self, chunk_id):
+        pos = self._pos(chunk_id)
+        if pos < 0: return None
+        row = self.index[pos]
+        start = int(row["offset"])
+        return self._blob[start:start + int(row["length"])].decode("utf-8")
+
+    def source(self, chunk_id):
+        pos = self._pos(chunk_id)
+        if pos < 0: return None
+        return self.files[int(self.index[pos]["file_id"])]
+
+    def records(self, chunk_ids=None):
+        """(id, テキスト, ファイル名) を順に返します。chunk_ids を渡すとその分だけ"""
+        if chunk_ids is None: chunk_ids = self.ids()
+        for chunk_id in chunk_ids:
+            text = self.get(chunk_id)
+            if text is not None: yield int(chunk_id), text, self.source(chunk_id)
@@ -1,13 +1,124 @@
-from llama_cpp import Llama
+from llama_cpp import Llama, LlamaGrammar
 import os
 import sys
+import time
+import glob
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from metrics import METRICS
+
+
+class PromptCache:
+    """
+    固定のシステムプロンプト部分（プレフィックス）を評価し終えたKV状態を保存しておくキャッシュ。
+    メモリ上は合計サイズの上限付きLRU、disk_dir を指定するとファイルにも保存します。
+    キーはモデルファイルとプレフィックス本文のハッシュなので、どちらかが変われば別物として扱われます。
+    """
+    def __init__(self, max_bytes, disk_dir=None, disk_max_files=16):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_files = disk_max_files
+        self.model_id = ""
+        self._items = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        if disk_dir and not os.path.exists(disk_dir): os.makedirs(disk_dir)
+
+    def set_model(self, model_path):
+        """モデルが変わったら、別モデルのKV状態は使えないので全部捨てます"""
+        st = os.stat(model_path)
+        model_id = hashlib.sha256(f"{os.path.basename(model_path)}:{st.st_size}:{int(st.st_mtime)}".encode()).hexdigest()[:16]
+        if model_id == self.model_id: return
+        self.model_id = model_id
+        self._items.clear()
+        self._bytes = 0
+        if self.disk_dir:
+            for path in glob.glob(os.path.join(self.disk_dir, "*.kv")):
+                if not os.path.basename(path).startswith(model_id):
+                    try: os.remove(path)
+                    except: pass
+
+    def key(self, prefix):
+        return f"{self.model_id}_{hashlib.sha256(prefix.encode('utf-8')).hexdigest()[:32]}"
+
+    def get(self, key):
+        state = self._items.get(key)
+        if state is not None:
+            self._items.move_to_end(key)
+            return state
+        if self.disk_dir:
+            path = os.path.join(self.disk_dir, key + ".kv")
+            if os.path.exists(path):
+                try:
+                    with open(path, "rb") as f: state = pickle.load(f)
+                    self._put_ram(key, state)
+                    return state
+                except Exception as e:
+                    print(f"KVキャッシュ読込エラー: {e}")
+        return None
+
+    def put(self, key, state):
+        self._put_ram(key, state)
+        if self.disk_dir:
+            path = os.path.join(self.disk_dir, key + ".kv")
+            # kv_cache_dir は全エンジン・全プロセスで共有するので、一時ファイルは書き手ごとに別の名前にします
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp, "wb") as f: pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+                files = sorted(glob.glob(os.path.join(self.disk_dir, "*.kv")), key=os.path.getmtime)
+                for old in files[:-self.disk_max_files]:
+                    # 他の書き手が先に消していることがあります
+                    try: os.remove(old)
+                    except OSError: pass
+            except Exception as e:
+                print(f"KVキャッシュ保存エラー: {e}")
+                try: os.remove(tmp)
+                except OSError: pass
+
+    def _put_ram(self, key, state):
+        if key in self._items:
+            self._bytes -= self._items.pop(key).llama_state_size
+        self._items[key] = state
+        self._bytes += state.llama_state_size
+        while self._bytes > self.max_bytes and len(self._items) > 1:
+            _, old = self._items.popitem(last=False)
+            self._bytes -= old.llama_state_size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "saved_prompt_tokens": self.saved_tokens,
+            "entries": len(self._items),
+            "bytes": self._bytes,
+        }
+
 
 class AIEngine:
     def __init__(self, config):
         self.llm = None
         self.config = config
-        # stop_flagは一括生成の場合はあまり意味がなくなりますが、互換性のため残します
+        # 生成中に stop() が呼ばれると、次のトークンの前で打ち切ります
         self.stop_flag = False
+        # 検索(RAG)と同じ Llama を共有する場合があるので、呼び出しはこのロックで直列化します
+        self.lock = threading.Lock()
+        # 直近の生成の計測値（初回トークンまでの秒数など）
+        self.last_ttft = None
+        self.last_stats = {}
+
+        # ★固定プロンプトのKVキャッシュ（kv_cache_ram_mb=0 で無効）
+        ram_mb = self.config.params.get("kv_cache_ram_mb", 1024)
+        disk_dir = self.config.params.get("kv_cache_dir", "")
+        self.prefix_cache = PromptCache(ram_mb * 1024 * 1024, disk_dir or None) if ram_mb > 0 else None
+        # GBNF文法は解析に少し時間がかかるので、文法の本文ごとに1回だけ作ります
+        self._grammars = {}
 
     def load_model(self, path):
         if not path or not os.path.exists(path):
@@ -19,48 +130,130 @@ class AIEngine:
             
             print(f"DEBUG: Load Model (Threads={threads}, ctx={n_ctx})")
             
-            self.llm = Llama(
-                model_path=path,
-                n_ctx=n_ctx,
-                n_threads=threads,
-                n_gpu_layers=0,
-                verbose=False 
-            )
+            with self.lock:
+                self.llm = Llama(
+                    model_path=path,
+                    n_ctx=n_ctx,
+                    n_threads=threads,
+                    n_gpu_layers=0,
+                    verbose=False 
+                )
+                if self.prefix_cache: self.prefix_cache.set_model(path)
             return True, os.path.basename(path)
         except Exception as e:
             return False, f"読込エラー: {e}"
 
-    def generate(self, prompt):
-        if not self.llm: return None
+    def _gen_kwargs(self):
+        stop_words = [
+            "User:", "ユーザー:", 
+            "System:", "システム:",
+            "<start_of_turn>", "<end_of_turn>",
+            "<|start_header_id|>", "<|eot_id|>",
+            "\n\n\n"
+        ]
+        return dict(
+            max_tokens=self.config.params["max_tokens"],
+            temperature=self.config.params["temperature"],
+            top_k=self.config.params["top_k"],
+            repeat_penalty=self.config.params["repeat_penalty"],
+            stop=stop_words,
+        )
+
+    def _prepare_prefix(self, prefix):
+        """
+        prefix を評価済みのKV状態にしておきます。
+        llama_cpp は直前の入力と先頭が一致する分の評価を飛ばすので、続けて呼ぶ本体の生成で効きます。
+        """
+        tokens = self.llm.tokenize(prefix.encode("utf-8"), add_bos=True, special=True)
+        cache = self.prefix_cache
+
+        # 直前の生成と同じプレフィックスなら、KVにそのまま残っています
+        n = len(tokens)
+        if self.llm.n_tokens >= n and list(self.llm.input_ids[:n]) == tokens:
+            cache.hits += 1
+            cache.saved_tokens += n
+            return
+
+        key = cache.key(prefix)
+        state = cache.get(key)
+        if state is not None:
+            self.llm.load_state(state)
+            cache.hits += 1
+            cache.saved_tokens += n
+            return
+
+        cache.misses += 1
+        self.llm.reset()
+        self.llm.eval(tokens)
+        cache.put(key, self.llm.save_state())
+
+    def _grammar(self, gbnf):
+        grammar = self._grammars.get(gbnf)
+        if grammar is None:
+            grammar = LlamaGrammar.from_string(gbnf, verbose=False)
+            self._grammars[gbnf] = grammar
+        return grammar
+
+    def count_tokens(self, text):
+        """プロンプトの詰め込み量を決める時などに使うトークン数（モデル未読込なら文字数で代用）"""
+        if not self.llm: return len(text)
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+    def cache_stats(self):
+        return self.prefix_cache.stats() if self.prefix_cache else {}
+
+    def generate_stream(self, prompt, prefix=None, grammar=None):
+        """
+        生成したテキストを少しずつ（トークンごとに）返すジェネレーター。
+        トークンの合間に stop_flag を確認するので、停止ボタンがすぐ効きます。
+        prefix に毎回同じシステムプロンプト部分を渡すと、その評価結果をキャッシュから再利用します。
+        grammar に GBNF の文法を渡すと、その形の文章しか出さず、形が完成した所で生成を終えます。
+        """
+        if not self.llm: return
         self.stop_flag = False
-        
-        try:
-            stop_words = [
-                "User:", "ユーザー:", 
-                "System:", "システム:",
-                "<start_of_turn>", "<end_of_turn>",
-                "<|start_header_id|>", "<|eot_id|>",
-                "\n\n\n"
-            ]
-
-            # ★ここを変更！ stream=False にして一括で受け取ります
-            output = self.llm(
-                prompt,
-                max_tokens=self.config.params["max_tokens"],
-                temperature=self.config.params["temperature"],
-                top_k=self.config.params["top_k"],
-                repeat_penalty=self.config.params["repeat_penalty"],
-                stop=stop_words,
-                stream=False  # ★ストリームをOFF
-            )
-            
-            # テキストだけを取り出して返します
-            text = output['choices'][0]['text']
-            return text
-            
-        except Exception as e:
-            print(f"Generate Error: {e}")
-            return None
+        self.last_ttft = None
+
+        t_start = time.perf_counter()
+        n_tokens = 0
+        prompt_tokens = 0
+        with self.lock:
+            try:
+                try: prompt_tokens = len(self.llm.tokenize(prompt.encode("utf-8"), add_bos=True, special=True))
+                except Exception: pass
+                if prefix and self.prefix_cache and prompt.startswith(prefix):
+                    try: self._prepare_prefix(prefix)
+                    except Exception as e: print(f"KVキャッシュエラー: {e}")
+                kwargs = self._gen_kwargs()
+                if grammar:
+                    try: kwargs["grammar"] = self._grammar(grammar)
+                    except Exception as e: print(f"文法の読込エラー（文法なしで生成します）: {e}")
+                for chunk in self.llm(prompt, stream=True, **kwargs):
+                    if self.stop_flag:
+                        print("（停止されました）")
+                        break
+                    delta = chunk['choices'][0]['text']
+                    if self.last_ttft is None:
+                        self.last_ttft = time.perf_counter() - t_start
+                    n_tokens += 1
+                    if delta: yield delta
+            except Exception as e:
+                print(f"Generate Error: {e}")
+            finally:
+                elapsed = time.perf_counter() - t_start
+                self.last_stats = {
+                    "ttft": self.last_ttft,
+                    "seconds": elapsed,
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": n_tokens,
+                    "stopped": self.stop_flag,
+                }
+                METRICS.record_generation(self.last_stats)
+
+    def generate(self, prompt, prefix=None, grammar=None):
+        """一括で文字列を受け取りたい呼び出し元向け（中身はストリームをつなげたもの）"""
+        if not self.llm: return None
+        text = "".join(self.generate_stream(prompt, prefix=prefix, grammar=grammar))
+        return text if text else None
 
     def stop(self):
         self.stop_flag = True
@@ -0,0 +1,174 @@
+import os
+import re
+import time
+import socket
+import threading
+
+# =========================================================
+# 🏭 複数台のWatcherで1つの exchange_box を分け合う仕組み
+#   受け取り : req_<ID>.pdf → clm_<ワーカー名>__<ID>.pdf への名前変更（成功した1台だけが担当）
+#   貸出期限 : 担当中は clm_ ファイルの更新時刻を定期的に新しくします。
+#              期限(lease_seconds)を過ぎたまま放置されたものは、落ちた台の分として req_ に戻します
+#   生存確認 : hb_<ワーカー名>.txt を数秒ごとに書き直します
+# =========================================================
+
+CLAIM_PREFIX = "clm_"
+HEARTBEAT_PREFIX = "hb_"
+SEP = "__"
+
+
+def default_worker_id():
+    return socket.gethostname()
+
+
+def safe_worker_id(worker_id):
+    """ファイル名に使えて、区切り(__)と紛れない名前にします"""
+    return re.sub(r"[^A-Za-z0-9\-]", "-", worker_id) or "worker"
+
+
+def is_fleet_file(name):
+    return name.startswith(CLAIM_PREFIX) or name.startswith(HEARTBEAT_PREFIX)
+
+
+def request_uid(filename):
+    """req_<ID>.txt / clm_<ワーカー名>__<ID>.txt のどちらからでも依頼IDを取り出します"""
+    name = os.path.splitext(os.path.basename(filename))[0]
+    if name.startswith(CLAIM_PREFIX) and SEP in name:
+        return name.split(SEP, 1)[1]
+    if name.startswith("req_"):
+        return name[len("req_"):]
+    return name
+
+
+class Fleet:
+    def __init__(self, box_dir, worker_id=None, lease_seconds=120.0, heartbeat_seconds=5.0):
+        self.box_dir = box_dir
+        self.worker_id = safe_worker_id(worker_id or default_worker_id())
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.heartbeat_path = os.path.join(box_dir, f"{HEARTBEAT_PREFIX}{self.worker_id}.txt")
+        self.info = ""
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._renew_loop, daemon=True)
+
+    def start(self):
+        # 前回この台が落ちた時に持ったままだった依頼は、すぐに返します（今は何も担当していないので）
+        returned = self.reclaim_expired(own_now=True)
+        if returned: print(f"🏭 前回の担当分 {returned}件を受付に戻しました")
+        self.write_heartbeat()
+        self._thread.start()
+        print(f"🏭 ワーカー名: {self.worker_id}（貸出期限 {self.lease_seconds:.0f}秒）")
+
+    def stop(self):
+        self._stopped.set()
+        try: os.remove(self.heartbeat_path)
+        except OSError: pass
+
+    # ----------------------------------------------------------------
+    # 受け取りと返却
+    # ----------------------------------------------------------------
+    def claim(self, req_path):
+        """名前変更に成功したら担当します。新しいパスを返し、他の台に取られていたら None"""
+        name = os.path.basename(req_path)
+        if not name.startswith("req_"): return None
+        claimed = os.path.join(self.box_dir, f"{CLAIM_PREFIX}{self.worker_id}{SEP}{name[len('req_'):]}")
+        try:
+            os.rename(req_path, claimed)
+        except OSError:
+            return None
+        try: os.utime(claimed, None)
+        except OSError: pass
+        with self._lock:
+            self._held.add(claimed)
+        return claimed
+
+    def release(self, claimed_path):
+        """担当を終えます（処理側が消し損ねた claim ファイルもここで消します）"""
+        with self._lock:
+            self._held.discard(claimed_path)
+        try: os.remove(claimed_path)
+        except OSError: pass
+
+    def reclaim_expired(self, own_now=False):
+        """期限切れの claim を req_ に戻し、戻した件数を返します（戻した依頼は普通の受付と同じに処理されます）"""
+        now = time.time()
+        returned = 0
+        try:
+            entries = list(os.scandir(self.box_dir))
+        except OSError:
+            return 0
+        for entry in entries:
+            name = entry.name
+            if not name.startswith(CLAIM_PREFIX) or SEP not in name: continue
+            owner, rest = name[len(CLAIM_PREFIX):].split(SEP, 1)
+            with self._lock:
+                if entry.path in self._held: continue
+            mine = owner == self.worker_id
+            try:
+                expired = now - entry.stat().st_mtime > self.lease_seconds
+            except OSError:
+                continue
+            if not (expired or (own_now and mine)): continue
+            try:
+                # 同時に何台かが戻そうとしても、名前変更に成功するのは1台だけです
+                os.rename(entry.path, os.path.join(self.box_dir, "req_" + rest))
+                returned += 1
+                print(f"🏭 {owner} の担当分を受付に戻しました: {rest}")
+            except OSError:
+                pass
+        return returned
+
+    # ----------------------------------------------------------------
+    # 生存確認
+    # ----------------------------------------------------------------
+    def write_heartbeat(self):
+        tmp = self.heartbeat_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="cp932", errors="replace") as f:
+                f.write(time.strftime("%Y/%m/%d %H:%M:%S") + f" - {self.worker_id}\n{self.info}")
+            os.replace(tmp, self.heartbeat_path)
+        except OSError as e:
+            print(f"ハートビート書き込みエラー: {e}")
+
+    def live_workers(self):
+        """ハートビートが新しいワーカー名の一覧（自分も含みます）"""
+        now = time.time()
+        alive = []
+        try:
+            for entry in os.scandir(self.box_dir):
+                if not entry.name.startswith(HEARTBEAT_PREFIX) or not entry.name.endswith(".txt"): continue
+                try:
+                    if now - entry.stat().st_mtime <= self.heartbeat_seconds * 3:
+                        alive.append(entry.name[len(HEARTBEAT_PREFIX):-len(".txt")])
+                except OSError:
+                    pass
+        except OSError:
+            pass
+        if self.worker_id not in alive: alive.append(self.worker_id)
+        return alive
+
+    def claimed_uids(self):
+        """どの台かが担当中（clm_）の依頼IDの一覧"""
+        uids = []
+        try:
+            for entry in os.scandir(self.box_dir):
+                if entry.name.startswith(CLAIM_PREFIX) and SEP in entry.name: uids.append(request_uid(entry.name))
+        except OSError:
+            pass
+        return uids
+
+    def is_publisher(self, alive=None):
+        """status.txt を書く台か（生きている台のうち名前が一番小さい1台だけが書きます）"""
+        return min(alive or self.live_workers()) == self.worker_id
+
+    def _renew_loop(self):
+        while not self._stopped.wait(self.heartbeat_seconds):
+            with self._lock:
+                held = list(self._held)
+            # 担当中の依頼の期限を延ばします（長いPDFでも他の台に取られないように）
+            for path in held:
+                try: os.utime(path, None)
+                except OSError: pass
+            self.write_heartbeat()
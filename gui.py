@@ -1,12 +1,14 @@
 import tkinter as tk
 from tkinter import scrolledtext, filedialog, messagebox, ttk
 import threading
+import time
 import os
 import glob
 import psutil
 from config import ConfigManager
 from rag import RAGManager
 from engine import AIEngine
+from metrics import setup_logging
 
 class AIChatApp:
     def __init__(self, root):
@@ -16,6 +18,7 @@ class AIChatApp:
         
         base_dir = os.path.dirname(os.path.abspath(__file__))
         self.config = ConfigManager(base_dir)
+        setup_logging(self.config.params.get("log_level", "INFO"))
         self.rag = RAGManager(base_dir)
         self.engine = AIEngine(self.config)
         
@@ -70,7 +73,7 @@ class AIChatApp:
 
         bf = tk.Frame(input_frame, bg="#f0f0f0"); bf.pack(side=tk.RIGHT, fill=tk.Y, padx=5, pady=5)
         tk.Button(bf, text="送信", command=self.send, bg="#ffb6c1", width=10, height=2).pack(pady=2)
-        # 停止ボタンは一括生成中は効きにくいですが残しておきます
+        # 停止ボタン：生成中のトークンの合間で打ち切ります
         self.stop_btn = tk.Button(bf, text="停止", command=self.engine.stop, state="disabled", width=10); self.stop_btn.pack(pady=2)
         tk.Button(bf, text="📂 読込", command=self.load_file, bg="#87ceeb", width=10).pack(pady=2)
         
@@ -152,11 +155,15 @@ class AIChatApp:
 
     def _load_th(self, path):
         ok, msg = self.engine.load_model(path)
-        if ok: self.root.after(0, lambda: self._post_load(msg))
+        if ok:
+            # embed_model の指定が無ければ、検索にも同じモデルを使います
+            self.rag.attach_model(self.engine.llm, path, self.engine.lock)
+            self.root.after(0, lambda: self._post_load(msg))
 
     def _post_load(self, name):
         self.root.title(f"AI Assistant (Office PC) - {name}")
         self.append_log("システム", f"モデル読込完了: {name}", "sys")
+        if self.rag.db_error: self.append_log("システム", self.rag.db_error, "sys")
         self.on_mode_change()
 
     def on_mode_change(self):
@@ -173,18 +180,25 @@ class AIChatApp:
         self.input_text.delete("1.0", tk.END)
         self.append_log("あなた", text, "user")
         
+        sys_msg = self.system_prompt
+        if not sys_msg: sys_msg = "あなたは優秀なアシスタントです。"
+        current_model_name = self.config.params.get("last_model", "").lower()
+
+        self.stop_btn.config(state="normal", bg="#ff4500")
+        
+        # UIが固まらないように、検索も生成も別スレッドで実行
+        # （検索は生成中のエンジンのロックを待つことがあるので、画面のスレッドでは行いません）
+        threading.Thread(target=self._gen_th, args=(text, sys_msg, current_model_name), daemon=True).start()
+
+    def _build_prompt(self, text, sys_msg, current_model_name):
         ctx, files = self.rag.get_context(text)
         
         if files:
-            self.append_log("システム", f"参照: {', '.join(files)}", "rag")
+            self.root.after(0, lambda: self.append_log("システム", f"参照: {', '.join(files)}", "rag"))
             rag_instruction = f"以下の【参照情報】を事実として、ユーザーの質問に答えてください。\n\n【参照情報】\n{ctx}"
         else:
             rag_instruction = "ユーザーの質問に親切に答えてください。"
 
-        sys_msg = self.system_prompt
-        if not sys_msg: sys_msg = "あなたは優秀なアシスタントです。"
-
-        current_model_name = self.config.params.get("last_model", "").lower()
         prompt = ""
         
         if "gemma" in current_model_name:
@@ -195,22 +209,40 @@ class AIChatApp:
             prompt = f"{sys_msg}\n\n{rag_instruction}\n\nユーザー: {text}\nシステム:"
         
         prompt = prompt.strip()
-
-        self.stop_btn.config(state="normal", bg="#ff4500")
         print(f"DEBUG: Model={current_model_name}, PromptLen={len(prompt)}")
-        
-        # UIが固まらないように別スレッドで実行
-        threading.Thread(target=self._gen_th, args=(prompt,), daemon=True).start()
+        return prompt
 
-    def _gen_th(self, prompt):
-        # ★ここを変更：一括生成を受け取る
-        res_text = self.engine.generate(prompt)
-        
+    def _gen_th(self, text, sys_msg, current_model_name):
+        prompt = self._build_prompt(text, sys_msg, current_model_name)
+
+        # ★トークンが届くたびに表示します。ただし画面更新は 50ms ごとにまとめて行います
+        pending = []
+        received = []
+        last_flush = 0.0
+
+        def flush():
+            text = "".join(pending)
+            pending.clear()
+            if text: self.root.after(0, lambda: self._insert_chunk(text))
+
+        for delta in self.engine.generate_stream(prompt):
+            if not received:
+                # AI枠を作って表示
+                self.root.after(0, lambda: self.append_log("AI", "", "ai"))
+            pending.append(delta)
+            received.append(delta)
+            now = time.perf_counter()
+            if now - last_flush >= 0.05:
+                flush()
+                last_flush = now
+        flush()
+
+        res_text = "".join(received)
         if res_text:
-            # AI枠を作って表示
-            self.root.after(0, lambda: self.append_log("AI", "", "ai"))
-            self.root.after(0, lambda: self._insert_chunk(res_text))
             self.history += f" {res_text}\n"
+        ttft = self.engine.last_ttft
+        if ttft is not None:
+            print(f"DEBUG: TTFT={ttft:.2f}s, tokens={self.engine.last_stats.get('completion_tokens')}")
             
         self.root.after(0, lambda: self.stop_btn.config(state="disabled", bg="#f0f0f0"))
 
@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import queue
+import random
+import threading
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# =========================================================
+# 🌐 HTTP の受付窓口（exchange_box と並ぶもう1つの入口）
+#   POST /ask            本文に質問（UTF-8）。回答ができた瞬間に返します（ロングポーリング）
+#   POST /ask?stream=1   生成中の文章を少しずつ返します（chunked）
+#   POST /pdf            本文にPDF。査読結果を返します
+#   GET  /result/<ID>    先に受け付けた依頼の結果を待って受け取ります
+#   GET  /status         待ち行列と見込み時間（JSON）
+# 依頼は exchange_box と同じ req_ ファイルにしてスケジューラーに直接積むので、
+# 順番・キャッシュ・まとめて回答などは箱から来た依頼と全く同じに扱われます。
+# 外部のサービスは使いません（既定では 127.0.0.1 だけで待ち受けます）
+# =========================================================
+
+_END = object()
+
+
+class ResultHub:
+    """HTTPで待っている依頼へ、生成途中の文章と最終結果を届ける中継所"""
+
+    def __init__(self, keep_seconds=600):
+        self.keep_seconds = keep_seconds
+        self._lock = threading.Lock()
+        self._streams = {}   # 依頼ID -> queue.Queue（文章の断片、最後に (_END, 結果)）
+        self._results = {}   # 依頼ID -> (届いた時刻, 結果)
+
+    def register(self, uid):
+        with self._lock:
+            self._streams[uid] = queue.Queue()
+
+    def is_registered(self, uid):
+        with self._lock:
+            return uid in self._streams
+
+    def push(self, uid, delta):
+        with self._lock:
+            q = self._streams.get(uid)
+        if q is not None: q.put(delta)
+
+    def deliver(self, uid, text):
+        """HTTPの依頼なら結果を渡して True を返します（False なら今まで通りファイルで返します）"""
+        now = time.time()
+        with self._lock:
+            q = self._streams.get(uid)
+            if q is None: return False
+            self._results[uid] = (now, text)
+            for old in [k for k, (t, _) in self._results.items() if now - t > self.keep_seconds]:
+                del self._results[old]
+                self._streams.pop(old, None)
+        q.put((_END, text))
+        return True
+
+    def wait(self, uid, timeout, on_delta=None):
+        """結果が届くまで待ちます。on_delta を渡すと、途中の文章もその都度渡します。時間切れなら None"""
+        with self._lock:
+            q = self._streams.get(uid)
+            done = self._results.get(uid)
+        if done is not None and on_delta is None: return done[1]
+        if q is None: return None
+
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0: return None
+            try:
+                item = q.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if isinstance(item, tuple) and item[0] is _END:
+                # 次に /result で取りに来た人のために、終わりの印は戻しておきます
+                q.put(item)
+                return item[1]
+            if on_delta: on_delta(item)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    channel = None   # HttpChannel（サーバーを作る時に差し込みます）
+
+    def log_message(self, fmt, *args):
+        pass
+
+    # ----------------------------------------------------------------
+    # 共通
+    # ----------------------------------------------------------------
+    def _authorized(self):
+        token = self.channel.token
+        if token and self.headers.get("X-Token", "") != token:
+            self._send(403, "forbidden")
+            return False
+        return True
+
+    def _send(self, code, text, content_type="text/plain; charset=utf-8", headers=None):
+        body = text.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items(): self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, text):
+        data = text.encode("utf-8")
+        if not data: return
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    # ----------------------------------------------------------------
+    # GET
+    # ----------------------------------------------------------------
+    def do_GET(self):
+        if not self._authorized(): return
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == "/status":
+            self._send(200, json.dumps(self.channel.watcher.scheduler.status(), ensure_ascii=False),
+                       "application/json; charset=utf-8")
+        elif url.path.startswith("/result/"):
+            uid = url.path[len("/result/"):]
+            if not self.channel.hub.is_registered(uid):
+                self._send(404, "unknown request id")
+                return
+            timeout = float(params.get("timeout", [self.channel.timeout])[0])
+            text = self.channel.hub.wait(uid, timeout)
+            if text is None: self._send(202, "processing", headers={"X-Request-Id": uid})
+            else: self._send(200, text, headers={"X-Request-Id": uid})
+        else:
+            self._send(404, "not found")
+
+    # ----------------------------------------------------------------
+    # POST
+    # ----------------------------------------------------------------
+    def do_POST(self):
+        if not self._authorized(): return
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length <= 0 or length > self.channel.max_body:
+            self._send(400, "empty or too large body")
+            return
+        body = self.rfile.read(length)
+
+        if url.path == "/ask":
+            text = body.decode("utf-8", errors="replace").strip()
+            if not text:
+                self._send(400, "empty question")
+                return
+            uid = self.channel.submit(text.encode("cp932", errors="replace"), ".txt")
+        elif url.path == "/pdf":
+            uid = self.channel.submit(body, ".pdf")
+        else:
+            self._send(404, "not found")
+            return
+        if uid is None:
+            self._send(503, "could not accept the request")
+            return
+
+        timeout = float(params.get("timeout", [self.channel.timeout])[0])
+        if params.get("stream", ["0"])[0] not in ("1", "true"):
+            text = self.channel.hub.wait(uid, timeout)
+            if text is None: self._send(202, "processing", headers={"X-Request-Id": uid})
+            else: self._send(200, text, headers={"X-Request-Id": uid})
+            return
+
+        # ★生成中の文章を、できた分から chunked で送ります
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("X-Request-Id", uid)
+        self.end_headers()
+        streamed = []
+
+        def on_delta(delta):
+            streamed.append(delta)
+            self._chunk(delta)
+
+        try:
+            text = self.channel.hub.wait(uid, timeout, on_delta)
+            # キャッシュから返した時などは途中の文章が無いので、結果をまとめて送ります
+            if text is not None and not streamed: self._chunk(text)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class HttpChannel:
+    def __init__(self, watcher, host="127.0.0.1", port=8765, token="", timeout=300.0):
+        self.watcher = watcher
+        self.hub = ResultHub()
+        self.token = token
+        self.timeout = timeout
+        self.max_body = 64 * 1024 * 1024
+        handler = type("Handler", (_Handler,), {"channel": self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        print(f"🌐 HTTP受付: http://{host}:{port}/ask")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def submit(self, data, ext):
+        """依頼を exchange_box に書き、スケジューラーへ直接積みます（フォルダの監視を待ちません。受付の上限も同じです）"""
+        uid = f"http_{datetime.now().strftime('%Y%m%d%H%M%S')}_{random.randint(100000, 999999)}"
+        box_dir = self.watcher.box_dir
+        path = os.path.join(box_dir, f"req_{uid}{ext}")
+        temp_path = os.path.join(box_dir, f"tmp_{uid}{ext}")
+        try:
+            with open(temp_path, "wb") as f: f.write(data)
+            self.hub.register(uid)
+            os.replace(temp_path, path)
+        except Exception as e:
+            print(f"HTTP受付エラー: {e}")
+            try: os.remove(temp_path)
+            except OSError: pass
+            return None
+        # 混んでいる時は、ここで断りの返事がそのまま届きます
+        self.watcher.accept(path)
+        return uid
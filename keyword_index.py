@@ -0,0 +1,155 @@
+import os
+import json
+import pickle
+import unicodedata
+from array import array
+from collections import Counter
+import numpy as np
+
+# 世代フォルダに保存するファイル（どれも np.load の mmap で開くので、起動時に全部は読みません）
+META_NAME = "keyword_meta.json"
+GRAMS_NAME = "keyword_grams.npy"      # バイグラムの昇順の表（<U2）
+OFFSETS_NAME = "keyword_offsets.npy"  # バイグラムごとの出現リストの開始位置（int64、長さはバイグラム数+1）
+IDS_NAME = "keyword_ids.npy"          # 全バイグラムの出現リストをつなげたもの（int64）
+IMPACTS_NAME = "keyword_impacts.npy"  # 同じ並びの BM25 の寄与度（float32）
+
+
+class KeywordIndex:
+    """
+    文字バイグラムの BM25 転置インデックス。
+    各バイグラムの出現リストは BM25 の寄与度（impact）が高い順に並べて保存し、
+    検索時は上位だけを読むので、コーパスが大きくなっても検索コストがほぼ一定です。
+    出現リストは1本の配列につなげて持ち、バイグラムの表と開始位置で引きます。
+    """
+
+    def __init__(self, grams=None, offsets=None, ids=None, impacts=None, n_docs=0):
+        self.grams = grams if grams is not None else np.zeros(0, dtype="<U2")
+        self.offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        self.ids = ids if ids is not None else np.zeros(0, dtype=np.int64)
+        self.impacts = impacts if impacts is not None else np.zeros(0, dtype=np.float32)
+        self.n_docs = n_docs
+
+    # ----------------------------------------------------------------
+    # 文字列の前処理
+    # ----------------------------------------------------------------
+    @staticmethod
+    def normalize(text):
+        text = unicodedata.normalize("NFKC", text).lower()
+        return "".join(text.split())
+
+    @classmethod
+    def grams_of(cls, text):
+        text = cls.normalize(text)
+        if len(text) == 1: return [text]
+        return [text[i:i + 2] for i in range(len(text) - 1)]
+
+    # ----------------------------------------------------------------
+    # 作成・保存
+    # ----------------------------------------------------------------
+    @classmethod
+    def build(cls, docs, k1=1.2, b=0.75, max_postings=2000):
+        """docs: (id, テキスト) の並び。max_postings は1バイグラムあたりに残す件数の上限"""
+        ids_by_gram = {}
+        tfs_by_gram = {}
+        doc_lens = {}
+
+        for doc_id, text in docs:
+            counts = Counter(cls.grams_of(text))
+            doc_lens[doc_id] = sum(counts.values())
+            for gram, tf in counts.items():
+                if gram not in ids_by_gram:
+                    ids_by_gram[gram] = array("q")
+                    tfs_by_gram[gram] = array("f")
+                ids_by_gram[gram].append(doc_id)
+                tfs_by_gram[gram].append(tf)
+
+        n_docs = len(doc_lens)
+        if not doc_lens: return cls()
+
+        avg_len = sum(doc_lens.values()) / len(doc_lens)
+        grams = sorted(ids_by_gram)
+        offsets = np.zeros(len(grams) + 1, dtype=np.int64)
+        id_parts = []
+        impact_parts = []
+        for n, gram in enumerate(grams):
+            ids = np.frombuffer(ids_by_gram[gram], dtype=np.int64)
+            tfs = np.frombuffer(tfs_by_gram[gram], dtype=np.float32)
+            lens = np.array([doc_lens[i] for i in ids], dtype=np.float32)
+
+            df = len(ids)
+            idf = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+            impacts = idf * tfs * (k1 + 1.0) / (tfs + k1 * (1.0 - b + b * lens / avg_len))
+
+            order = np.argsort(-impacts, kind="stable")[:max_postings]
+            id_parts.append(ids[order])
+            impact_parts.append(impacts[order].astype(np.float32))
+            offsets[n + 1] = offsets[n] + len(order)
+        return cls(np.array(grams, dtype="<U2"), offsets,
+                   np.concatenate(id_parts).astype(np.int64), np.concatenate(impact_parts).astype(np.float32), n_docs)
+
+    def save(self, dir_path):
+        np.save(os.path.join(dir_path, GRAMS_NAME), self.grams)
+        np.save(os.path.join(dir_path, OFFSETS_NAME), self.offsets)
+        np.save(os.path.join(dir_path, IDS_NAME), self.ids)
+        np.save(os.path.join(dir_path, IMPACTS_NAME), self.impacts)
+        # meta は最後に書くので、これがあれば全部そろっています
+        with open(os.path.join(dir_path, META_NAME), "w", encoding="utf-8") as f:
+            json.dump({"version": 2, "n_docs": self.n_docs}, f)
+
+    @staticmethod
+    def exists(dir_path):
+        return os.path.exists(os.path.join(dir_path, META_NAME))
+
+    @classmethod
+    def load(cls, dir_path):
+        with open(os.path.join(dir_path, META_NAME), "r", encoding="utf-8") as f: meta = json.load(f)
+        arrays = [np.load(os.path.join(dir_path, name), mmap_mode="r")
+                  for name in (GRAMS_NAME, OFFSETS_NAME, IDS_NAME, IMPACTS_NAME)]
+        return cls(*arrays, n_docs=meta["n_docs"])
+
+    @classmethod
+    def load_pickle(cls, path):
+        """以前の形式（keyword.pkl）を読み、今の形式に並べ直します"""
+        with open(path, "rb") as f: data = pickle.load(f)
+        postings = data["postings"]
+        grams = sorted(postings)
+        offsets = np.zeros(len(grams) + 1, dtype=np.int64)
+        for n, gram in enumerate(grams): offsets[n + 1] = offsets[n] + len(postings[gram][0])
+        if not grams: return cls(n_docs=data["n_docs"])
+        return cls(np.array(grams, dtype="<U2"), offsets,
+                   np.concatenate([postings[g][0] for g in grams]).astype(np.int64),
+                   np.concatenate([postings[g][1] for g in grams]).astype(np.float32), data["n_docs"])
+
+    # ----------------------------------------------------------------
+    # 検索
+    # ----------------------------------------------------------------
+    def _postings(self, gram):
+        pos = int(np.searchsorted(self.grams, gram))
+        if pos >= len(self.grams) or self.grams[pos] != gram: return None
+        start, end = int(self.offsets[pos]), int(self.offsets[pos + 1])
+        return start, end
+
+    def search(self, query, k=50, per_gram=1000):
+        """(id, スコア) をスコアの高い順に最大k件返します"""
+        id_parts = []
+        score_parts = []
+        for gram in set(self.grams_of(query)):
+            hit = self._postings(gram)
+            if hit is None: continue
+            start, end = hit
+            end = min(end, start + per_gram)
+            id_parts.append(self.ids[start:end])
+            score_parts.append(self.impacts[start:end])
+        if not id_parts: return []
+
+        ids = np.concatenate(id_parts)
+        scores = np.concatenate(score_parts)
+        uniq, inverse = np.unique(ids, return_inverse=True)
+        totals = np.bincount(inverse, weights=scores)
+
+        if len(totals) > k:
+            top = np.argpartition(-totals, k)[:k]
+        else:
+            top = np.arange(len(totals))
+        top = top[np.argsort(-totals[top])]
+        return [(int(uniq[i]), float(totals[i])) for i in top]
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# =========================================================
+# 📈 処理時間・トークン数の計測
+#   依頼1件ごとに Trace を作り、段階（待ち・検索・生成など）ごとの秒数を記録します。
+#   集計は logs/metrics.json と logs/metrics.prom（Prometheus の textfile 形式）に、
+#   1件ごとの記録は logs/trace.jsonl に1行ずつ書き出します
+# =========================================================
+
+PROM_PREFIX = "excel_ai"
+
+
+def setup_logging(level="INFO"):
+    """config.json の log_level（DEBUG / INFO / WARNING）で、検索の内訳などの詳しいログを出すか決めます"""
+    logging.basicConfig(level=getattr(logging, str(level).upper(), logging.INFO), format="%(message)s")
+
+
+class Trace:
+    """依頼1件（または知識DBの作成1回）の記録"""
+
+    def __init__(self, kind, request_id="", lane=""):
+        self.kind = kind
+        self.request_id = request_id
+        self.lane = lane
+        self.started = time.time()
+        self.stages = {}   # 段階の名前 -> 秒（同じ段階が何度あれば合計）
+        self.counts = {}   # トークン数など
+        self.tags = {}     # キャッシュ利用などの目印
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def to_dict(self):
+        return {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+            "kind": self.kind,
+            "id": self.request_id,
+            "lane": self.lane,
+            "total": round(time.time() - self.started, 4),
+            "stages": {k: round(v, 4) for k, v in self.stages.items()},
+            "counts": self.counts,
+            "tags": self.tags,
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.log_dir = None
+        self.trace_max_bytes = 5 * 1024 * 1024
+        self.started = time.time()
+        self._stages = {}    # (種類, 段階) -> [回数, 合計秒, 最大秒]
+        self._counters = {}  # (種類, 名前) -> 値
+        self._gauges = {}    # 名前 -> 値を返す関数（数値 か {ラベル: 数値}）
+
+    def configure(self, log_dir):
+        if self.log_dir: return
+        if not os.path.exists(log_dir): os.makedirs(log_dir)
+        self.log_dir = log_dir
+
+    # ----------------------------------------------------------------
+    # 記録
+    # ----------------------------------------------------------------
+    def start(self, kind, request_id="", lane=""):
+        """この後同じスレッドで計った時間は、返した Trace に入ります"""
+        trace = Trace(kind, request_id, lane)
+        self._local.trace = trace
+        return trace
+
+    def current(self):
+        return getattr(self._local, "trace", None)
+
+    @contextmanager
+    def stage(self, name):
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t_start)
+
+    def observe(self, name, seconds):
+        trace = self.current()
+        if trace: trace.add(name, seconds)
+        kind = trace.kind if trace else "other"
+        with self._lock:
+            st = self._stages.setdefault((kind, name), [0, 0.0, 0.0])
+            st[0] += 1
+            st[1] += seconds
+            st[2] = max(st[2], seconds)
+
+    def count(self, name, n=1):
+        trace = self.current()
+        if trace: trace.counts[name] = trace.counts.get(name, 0) + n
+        kind = trace.kind if trace else "other"
+        with self._lock:
+            self._counters[(kind, name)] = self._counters.get((kind, name), 0) + n
+
+    def tag(self, name, value=True):
+        trace = self.current()
+        if trace: trace.tags[name] = value
+
+    def record_generation(self, stats):
+        """AIEngine.last_stats から、プロンプト評価（最初のトークンまで）と生成の時間・トークン数を記録します"""
+        ttft = stats.get("ttft")
+        if ttft is not None:
+            self.observe("prompt_eval", ttft)
+            self.observe("generate", max(0.0, stats.get("seconds", 0.0) - ttft))
+        self.count("prompt_tokens", stats.get("prompt_tokens", 0))
+        self.count("completion_tokens", stats.get("completion_tokens", 0))
+        self.count("generations")
+
+    def finish(self, trace):
+        """1件ぶんを締めて trace.jsonl に書き出します"""
+        if self.current() is trace: self._local.trace = None
+        line = trace.to_dict()
+        with self._lock:
+            st = self._stages.setdefault((trace.kind, "total"), [0, 0.0, 0.0])
+            st[0] += 1
+            st[1] += line["total"]
+            st[2] = max(st[2], line["total"])
+            self._counters[(trace.kind, "requests")] = self._counters.get((trace.kind, "requests"), 0) + 1
+            if not self.log_dir: return
+            path = os.path.join(self.log_dir, "trace.jsonl")
+            try:
+                # 大きくなりすぎたら1世代だけ残して新しいファイルにします
+                if os.path.exists(path) and os.path.getsize(path) > self.trace_max_bytes:
+                    os.replace(path, path + ".1")
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(line, ensure_ascii=False) + "\n")
+            except Exception as e:
+                print(f"トレース書き込みエラー: {e}")
+
+    def gauge(self, name, fn):
+        """待ち件数やキャッシュのヒット率など、書き出す時に毎回取り直す値を登録します"""
+        self._gauges[name] = fn
+
+    # ----------------------------------------------------------------
+    # 書き出し
+    # ----------------------------------------------------------------
+    def snapshot(self):
+        with self._lock:
+            stages = {}
+            for (kind, name), (n, total, peak) in self._stages.items():
+                stages.setdefault(kind, {})[name] = {
+                    "count": n, "sum": round(total, 4), "avg": round(total / n, 4) if n else 0.0, "max": round(peak, 4)}
+            counters = {}
+            for (kind, name), value in self._counters.items():
+                counters.setdefault(kind, {})[name] = value
+
+        # 生成の速さ（トークン/秒）は生成時間の合計から出します
+        for kind, values in counters.items():
+            gen = stages.get(kind, {}).get("generate")
+            if gen and gen["sum"] > 0:
+                values["tokens_per_s"] = round(values.get("completion_tokens", 0) / gen["sum"], 2)
+
+        gauges = {}
+        for name, fn in list(self._gauges.items()):
+            try: gauges[name] = fn()
+            except Exception: pass
+        return {
+            "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "uptime": round(time.time() - self.started, 1),
+            "stages": stages,
+            "counters": counters,
+            "gauges": gauges,
+        }
+
+    def prometheus(self, snap=None):
+        snap = snap or self.snapshot()
+        lines = [f"# TYPE {PROM_PREFIX}_stage_seconds summary"]
+        for kind, names in snap["stages"].items():
+            for name, st in names.items():
+                labels = f'kind="{kind}",stage="{name}"'
+                lines.append(f"{PROM_PREFIX}_stage_seconds_sum{{{labels}}} {st['sum']}")
+                lines.append(f"{PROM_PREFIX}_stage_seconds_count{{{labels}}} {st['count']}")
+                lines.append(f"{PROM_PREFIX}_stage_seconds_max{{{labels}}} {st['max']}")
+        for kind, values in snap["counters"].items():
+            for name, value in values.items():
+                lines.append(f'{PROM_PREFIX}_{name}{{kind="{kind}"}} {value}')
+        for name, value in snap["gauges"].items():
+            if isinstance(value, dict):
+                for label, v in value.items():
+                    if isinstance(v, (int, float)): lines.append(f'{PROM_PREFIX}_{name}{{key="{label}"}} {v}')
+            elif isinstance(value, (int, float)):
+                lines.append(f"{PROM_PREFIX}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """logs/metrics.json と logs/metrics.prom を置き換えます（読む側が書きかけを見ないよう一時ファイル経由）"""
+        if not self.log_dir: return
+        snap = self.snapshot()
+        for name, text in (("metrics.json", json.dumps(snap, ensure_ascii=False, indent=1)),
+                           ("metrics.prom", self.prometheus(snap))):
+            path = os.path.join(self.log_dir, name)
+            try:
+                with open(path + ".tmp", "w", encoding="utf-8") as f: f.write(text)
+                os.replace(path + ".tmp", path)
+            except Exception as e:
+                print(f"メトリクス書き込みエラー: {e}")
+
+
+# プロセスに1つの集計先（Watcher・GUI・検索・エンジンから共通で使います）
+METRICS = Metrics()
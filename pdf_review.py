@@ -0,0 +1,439 @@
+import re
+import sys
+import time
+import queue
+import unicodedata
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pypdf import PdfReader
+from result_cache import make_key
+
+# =========================================================
+# 📄 PDF査読のページ単位の処理
+#   1プロセスで順番に処理する時も、複数プロセスに分ける時も同じ関数を使います
+# =========================================================
+
+FAILED_TEXT = "（エラー：生成失敗）"
+
+
+def build_page_prompt(sys_msg, model_name, page_num, text):
+    """1ページ分の (プロンプト, 共通プレフィックス) を返します。page_num は1始まり"""
+    question = f"【対象テキスト：第{page_num}ページ】\n{text}"
+
+    # prefix は毎ページ共通の部分。評価済みのKV状態をキャッシュから再利用します
+    if "gemma" in model_name:
+        prefix = f"<start_of_turn>user\n{sys_msg}\n\n"
+        prompt = f"{prefix}{question}<end_of_turn>\n<start_of_turn>model\n"
+    elif "elyza" in model_name or "llama-3" in model_name:
+        prefix = f"<|start_header_id|>system<|end_header_id|>\n\n{sys_msg}<|eot_id|>"
+        prompt = f"{prefix}<|start_header_id|>user<|end_header_id|>\n\n{question}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n"
+    else:
+        prefix = f"{sys_msg}\n\n"
+        prompt = f"{prefix}ユーザー: {question}\nシステム:"
+    return prompt, prefix
+
+
+def generate_page(engine, prompt, prefix, grammar=None):
+    response = engine.generate(prompt, prefix=prefix, grammar=grammar)
+    if isinstance(response, dict):
+        response = response['choices'][0]['text']
+    return response or FAILED_TEXT
+
+
+def review_page(engine, sys_msg, model_name, page_num, text, grammar=None):
+    prompt, prefix = build_page_prompt(sys_msg, model_name, page_num, text)
+    return generate_page(engine, prompt, prefix, grammar)
+
+
+# =========================================================
+# 🧾 回答を指摘の一覧（レコード）に分解
+#   proofread.gbnf で形を決めていれば必ずこの形になります。文法なしの回答でも読める分は読みます
+# =========================================================
+FINDING = re.compile(
+    r"[\[［]\s*[PＰ][\.．]?\s*([0-9０-９]+)\s*[\]］]\s*"
+    r"【対象箇所】\s*[:：]\s*「(.*?)」\s*"
+    r"【理由】\s*[:：]\s*(.*?)\s*"
+    r"【修正案】\s*[:：]\s*「(.*?)」", re.S)
+
+
+def parse_findings(response):
+    """[{"page": ページ番号, "target": 対象箇所, "reason": 理由, "fix": 修正案}, ...] を返します"""
+    return [
+        {"page": int(unicodedata.normalize("NFKC", m.group(1))), "target": m.group(2).strip(),
+         "reason": m.group(3).strip(), "fix": m.group(4).strip()}
+        for m in FINDING.finditer(response or "")
+    ]
+
+
+def format_finding(finding):
+    return (f"・[P.{finding['page']}] 【対象箇所】: 「{finding['target']}」\n"
+            f"  【理由】: {finding['reason']}\n"
+            f"  【修正案】: 「{finding['fix']}」")
+
+
+def is_clean(response):
+    """指摘が1つも無い回答か（形どおりの指摘が読めない時だけ「特になし」の文字で判断します）"""
+    if parse_findings(response): return False
+    return not response or not response.strip() or "特になし" in response
+
+
+def report_text(response):
+    """報告書に載せる文章。読めた指摘は形を揃え、読めない回答はそのまま載せます"""
+    findings = parse_findings(response)
+    if findings: return "\n\n".join(format_finding(f) for f in findings)
+    return response.strip()
+
+
+# =========================================================
+# 📦 短いページの詰め込み
+#   数行しかないページは、n_ctx の一定割合(pdf_pack_ratio)に収まるまで1回の呼び出しにまとめます。
+#   回答は [P.n] の印でページごとに切り分けるので、報告書の形は1ページずつの時と同じです
+# =========================================================
+PACK_NOTE = ("\n\n【注意】複数のページをまとめて渡しています。"
+             "指摘には必ず該当ページの [P.ページ数] を付けてください。"
+             "どのページにも指摘がなければ「特になし」とだけ回答してください。")
+PAGE_MARK = re.compile(r"\[P\.?\s*(\d+)\s*\]")
+
+
+def page_block(page_num, text):
+    return f"【対象テキスト：第{page_num}ページ】\n{text}"
+
+
+def build_pack_prompt(sys_msg, model_name, pages):
+    """複数ページ分の (プロンプト, 共通プレフィックス) を返します"""
+    body = "\n\n".join(page_block(page_num, text) for page_num, text in pages)
+    sys_msg = sys_msg + PACK_NOTE
+    if "gemma" in model_name:
+        prefix = f"<start_of_turn>user\n{sys_msg}\n\n"
+        prompt = f"{prefix}{body}<end_of_turn>\n<start_of_turn>model\n"
+    elif "elyza" in model_name or "llama-3" in model_name:
+        prefix = f"<|start_header_id|>system<|end_header_id|>\n\n{sys_msg}<|eot_id|>"
+        prompt = f"{prefix}<|start_header_id|>user<|end_header_id|>\n\n{body}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n"
+    else:
+        prefix = f"{sys_msg}\n\n"
+        prompt = f"{prefix}ユーザー: {body}\nシステム:"
+    return prompt, prefix
+
+
+def pack_budget(engine, sys_msg, ratio):
+    """1回の呼び出しでページ本文に使えるトークン数（回答の max_tokens 分は空けておきます）"""
+    n_ctx = engine.config.params.get("n_ctx", 8192)
+    max_tokens = engine.config.params.get("max_tokens", 1024)
+    limit = min(int(n_ctx * ratio), n_ctx - max_tokens)
+    return limit - engine.count_tokens(sys_msg + PACK_NOTE) - 32
+
+
+def iter_packs(pages, count_tokens, budget):
+    """(ページ番号, テキスト) の並びを、合計トークン数が budget に収まるまとまりにして順に返します"""
+    pack = []
+    used = 0
+    for item in pages:
+        page_num, text = item[0], item[1]
+        cost = count_tokens(page_block(page_num, text)) + 2
+        if pack and used + cost > budget:
+            yield pack
+            pack = []
+            used = 0
+        # 1ページだけで予算を超える時も、そのページは単独で1回にします
+        pack.append((page_num, text))
+        used += cost
+    if pack: yield pack
+
+
+def split_by_page(response, page_nums):
+    """
+    まとめて査読した回答を [P.n] の印で切り分け、{ページ番号: 回答} を返します。
+    指摘の無いページは「特になし」になります。
+    """
+    entries = {n: [] for n in page_nums}
+    current = None
+    orphan = []
+    for line in response.splitlines():
+        m = PAGE_MARK.search(unicodedata.normalize("NFKC", line))
+        if m and int(m.group(1)) in entries:
+            current = entries[int(m.group(1))]
+            current.append([line])
+        elif current is not None:
+            current[-1].append(line)
+        elif line.strip():
+            orphan.append(line)
+
+    results = {}
+    for n, items in entries.items():
+        texts = []
+        for item in items:
+            text = "\n".join(item).strip()
+            rest = PAGE_MARK.sub("", unicodedata.normalize("NFKC", text)).strip(" ・-:：\n")
+            if rest and rest != "特になし": texts.append(text)
+        results[n] = "\n\n".join(texts) if texts else "特になし"
+
+    # 印の無い指摘は捨てずに、まとまりの先頭ページに範囲付きで残します
+    orphan = "\n".join(orphan).strip()
+    if orphan and orphan != "特になし":
+        first = page_nums[0]
+        note = f"[P.{first}～{page_nums[-1]}] {orphan}"
+        results[first] = note if results[first] == "特になし" else results[first] + "\n\n" + note
+    return results
+
+
+def review_pack(engine, sys_msg, model_name, pages, grammar=None):
+    """ページのまとまりを1回で査読し、{ページ番号: 回答} を返します"""
+    if len(pages) == 1:
+        page_num, text = pages[0]
+        return {page_num: review_page(engine, sys_msg, model_name, page_num, text, grammar)}
+    prompt, prefix = build_pack_prompt(sys_msg, model_name, pages)
+    response = generate_page(engine, prompt, prefix, grammar)
+    if response == FAILED_TEXT:
+        return {page_num: FAILED_TEXT for page_num, _ in pages}
+    return split_by_page(response, [page_num for page_num, _ in pages])
+
+
+def page_cache_key(text, model_id, sys_msg):
+    """改行や空白の揺れ・全角半角の違いだけなら同じページとして扱います"""
+    normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+    return make_key("pdf_page", normalized, model_id, make_key(sys_msg))
+
+
+# 回答の中のページの印（[P.3] / ［Ｐ．３］ / まとめて査読した時の [P.3～5]）
+ANY_PAGE_MARK = re.compile(r"[\[［]\s*[PＰ][\.．]?\s*[0-9０-９]+(?:\s*[～~\-－]\s*[0-9０-９]+)?\s*[\]］]")
+
+
+def with_page(response, page_num):
+    """
+    キャッシュの回答のページの印を、今回のページ番号に書き換えます。
+    キーはページの文章だけで作るので、同じ文章が別のページ（ずれた再提出・繰り返しのひな形）にあっても使えます。
+    """
+    return ANY_PAGE_MARK.sub(f"[P.{page_num}]", response)
+
+
+# =========================================================
+# 📚 ページの先読み
+#   裏のスレッドが1ページずつ文字を取り出してプロンプトまで組み立て、
+#   上限付きのキューに積んでおきます。AIが前のページを書いている間に次のページの準備が進みます
+# =========================================================
+_END = object()
+
+
+class PageFeeder:
+    """
+    for page_num, text, prompt, prefix in PageFeeder(...) の形で、空白でないページを順に返します。
+    sys_msg を渡さない時は prompt / prefix は None です。
+    読み込みエラーは、受け取る側の for 文の中でそのまま発生します。
+    """
+
+    def __init__(self, pdf_path, queue_size=4, sys_msg=None, model_name=""):
+        self.pdf_path = pdf_path
+        self.sys_msg = sys_msg
+        self.model_name = model_name
+        self.extract_seconds = 0.0   # 文字の取り出しとプロンプト組み立てにかかった合計
+        self.wait_seconds = 0.0      # 受け取る側が次のページを待たされた合計（隠しきれなかった分）
+        self.pages = 0
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._closed = False
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            # PdfReader はページの中身を触った時に初めて解析するので、1ページずつ読み進められます
+            reader = PdfReader(self.pdf_path)
+            for index, page in enumerate(reader.pages):
+                if self._closed: return
+                t_start = time.perf_counter()
+                text = page.extract_text()
+                if not text or not text.strip():
+                    self.extract_seconds += time.perf_counter() - t_start
+                    continue # 空白ページはスキップ
+                text = text.strip()
+                prompt = prefix = None
+                if self.sys_msg is not None:
+                    prompt, prefix = build_page_prompt(self.sys_msg, self.model_name, index + 1, text)
+                self.extract_seconds += time.perf_counter() - t_start
+                if not self._put((index + 1, text, prompt, prefix)): return
+            self._put(_END)
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        try:
+            while True:
+                t_start = time.perf_counter()
+                item = self._queue.get()
+                self.wait_seconds += time.perf_counter() - t_start
+                if item is _END: return
+                if isinstance(item, Exception): raise item
+                self.pages += 1
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._closed = True
+
+    def hidden_seconds(self):
+        """生成の裏に隠れた取り出し時間"""
+        return max(0.0, self.extract_seconds - self.wait_seconds)
+
+    def summary(self):
+        return (f"抽出 {self.extract_seconds:.2f}秒 / 待ち {self.wait_seconds:.2f}秒 "
+                f"（生成の裏に隠れた分 {self.hidden_seconds():.2f}秒, {self.pages}ページ）")
+
+
+# =========================================================
+# 🧵 複数プロセスでの並列査読
+#   ワーカーはそれぞれ自分の AIEngine を持ち、ページ範囲を1つずつ受け持ちます
+# =========================================================
+_worker_engine = None
+
+
+def _worker_init(base_dir, model_path, n_threads):
+    global _worker_engine
+    if base_dir not in sys.path: sys.path.insert(0, base_dir)
+    from config import ConfigManager
+    from engine import AIEngine
+
+    config = ConfigManager(base_dir)
+    # CPUのスレッドはワーカー同士で分け合います
+    config.params["n_threads"] = n_threads
+    _worker_engine = AIEngine(config)
+    ok, msg = _worker_engine.load_model(model_path)
+    if not ok: raise RuntimeError(msg)
+
+
+def _worker_run(task):
+    """task: (ページ範囲の番号, [(ページ番号, テキスト), ...], sys_msg, model_name, まとめて1回にするか, 文法)"""
+    range_no, pages, sys_msg, model_name, packed, grammar = task
+    if packed:
+        return range_no, list(review_pack(_worker_engine, sys_msg, model_name, pages, grammar).items())
+    return range_no, [(page_num, review_page(_worker_engine, sys_msg, model_name, page_num, text, grammar))
+                      for page_num, text in pages]
+
+
+class ReviewPool:
+    """
+    並列査読用のプロセスプール。PDFレーンのワーカー1つにつき1つ作り、プロセスを使い回します。
+    各プロセスはモデルを最初の1回だけ読み込み、以後のPDFでもそのまま使います。
+    ワーカーが落ちた時だけ reset() で作り直します。
+    """
+
+    def __init__(self, base_dir, model_path, procs, threads_total=6):
+        self.base_dir = base_dir
+        self.model_path = model_path
+        self.procs = procs
+        # CPUのスレッドはワーカー同士で分け合います
+        self.threads = max(1, threads_total // procs)
+        self._executor = None
+
+    def matches(self, model_path, procs):
+        return self.model_path == model_path and self.procs == procs
+
+    def executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                self.procs, mp_context=multiprocessing.get_context("spawn"), initializer=_worker_init,
+                initargs=(self.base_dir, self.model_path, self.threads))
+        return self._executor
+
+    def reset(self):
+        if self._executor is None: return
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    def close(self):
+        self.reset()
+
+
+def review_pages_parallel(pages, sys_msg, model_name, pool, pages_per_task=2, max_retries=2, packs=None, grammar=None):
+    """
+    pages: (ページ番号, テキスト) の並びを pool（ReviewPool）のプロセスで査読し、{ページ番号: 回答} を返します。
+    pages は PageFeeder のような逐次の並びでもよく、範囲がたまった順にワーカーへ渡します。
+    packs に iter_packs(...) を渡すと、そのまとまりを1回の呼び出しで査読します（pages は使いません）。
+    途中でワーカーが落ちても、済んだ範囲はそのまま使い、終わっていない範囲だけをやり直します。
+    """
+    ranges = []
+    results = {}
+    pending = None
+
+    def submit_all(executor, futures, unsent):
+        def submit(n):
+            try:
+                futures[executor.submit(_worker_run, (n, ranges[n], sys_msg, model_name, packs is not None, grammar))] = n
+            except BrokenProcessPool:
+                # 投入中にワーカーが落ちても、残りのページは読み切って次の回に回します
+                unsent.append(n)
+
+        if pending is not None:
+            for n in pending: submit(n)
+            return
+        # 1回目は、ページを読みながら範囲がたまるたびに投入します
+        if packs is not None:
+            for pack in packs:
+                ranges.append(pack)
+                submit(len(ranges) - 1)
+            return
+        chunk = []
+        for item in pages:
+            chunk.append((item[0], item[1]))
+            if len(chunk) < pages_per_task: continue
+            ranges.append(chunk)
+            submit(len(ranges) - 1)
+            chunk = []
+        if chunk:
+            ranges.append(chunk)
+            submit(len(ranges) - 1)
+
+    for attempt in range(max_retries + 1):
+        if pending is not None and not pending: break
+        if attempt: print(f"   🔁 {len(pending)}範囲をやり直します（{attempt}回目）")
+        failed = []
+        unsent = []
+        futures = {}
+        broken = False
+        t_start = time.perf_counter()
+        try:
+            submit_all(pool.executor(), futures, unsent)
+            for fut in as_completed(futures):
+                n = futures[fut]
+                try:
+                    _, page_results = fut.result()
+                except BrokenProcessPool:
+                    # プロセスが落ちると、その時点で終わっていない範囲はすべてここに来ます
+                    failed.append(n)
+                    broken = True
+                    continue
+                except Exception as e:
+                    print(f"   ⚠️ P.{ranges[n][0][0]}～{ranges[n][-1][0]} エラー: {e}")
+                    failed.append(n)
+                    continue
+                for page_num, response in page_results:
+                    results[page_num] = response
+                print(f"   📖 P.{ranges[n][0][0]}～{ranges[n][-1][0]} 完了")
+        except Exception as e:
+            # 使い回すプールに、この依頼の残りの仕事を残さないようにします
+            for fut in futures: fut.cancel()
+            # ページの読み込みエラーは呼び出し元に任せます
+            if pending is None and not isinstance(e, BrokenProcessPool): raise
+            print(f"   ⚠️ 並列査読エラー: {e}")
+            failed = [n for n in range(len(ranges)) if ranges[n][0][0] not in results]
+            broken = True
+        # 落ちたプロセスのプールは使えないので、次の回（と次のPDF）のために作り直します
+        if broken or unsent: pool.reset()
+        print(f"   ⏱ {pool.procs}プロセスで {time.perf_counter() - t_start:.1f}秒")
+        # 同じ範囲が両方に入っていることがあるので、重複を除いてやり直します
+        pending = sorted(set(failed) | set(unsent))
+
+    for n in pending:
+        for page_num, _ in ranges[n]:
+            results[page_num] = FAILED_TEXT
+    return results
@@ -0,0 +1,90 @@
+import os
+import re
+
+# =========================================================
+# 🔎 AIに渡す前の簡易チェック
+#   正規表現（C実装）でページ全体を一度に走査し、怪しい箇所が1つも無いページを見分けます。
+#   見つけられるのは機械的な誤りだけなので、見逃しが心配な時は defer（後回し）で使ってください
+# =========================================================
+
+# 同じ助詞が続く（「をを」「にに」など）
+DOUBLED_PARTICLE = re.compile(r"(が|を|に|へ|で|から|より|まで)\1")
+
+# よくある誤字（誤 → 正）。typo_dict.txt に「誤字 正しい表記」を1行ずつ書くと追加できます
+DEFAULT_TYPOS = {
+    "以外と": "意外と",
+    "確立が高い": "確率が高い",
+    "講議": "講義",
+    "専問": "専門",
+    "完壁": "完璧",
+    "一同に会する": "一堂に会する",
+    "意味慎重": "意味深長",
+    "責任転化": "責任転嫁",
+    "絶対絶命": "絶体絶命",
+    "危機一発": "危機一髪",
+    "短刀直入": "単刀直入",
+    "異句同音": "異口同音",
+    "五里夢中": "五里霧中",
+    "ご確認下さいませ": "ご確認くださいませ",
+    "見れる": "見られる",
+    "来れる": "来られる",
+    "食べれる": "食べられる",
+    "とうり": "とおり",
+    "こんにちわ": "こんにちは",
+    "づつ": "ずつ",
+}
+
+# 全角と半角が1ページの中で混ざっているもの（どちらか片方だけなら問題にしません）
+WIDTH_PAIRS = [
+    ("半角数字", re.compile(r"[0-9]"), "全角数字", re.compile(r"[０-９]")),
+    ("半角英字", re.compile(r"[A-Za-z]"), "全角英字", re.compile(r"[Ａ-Ｚａ-ｚ]")),
+    ("半角かっこ", re.compile(r"[()]"), "全角かっこ", re.compile(r"[（）]")),
+    ("読点「，」", re.compile(r"，"), "読点「、」", re.compile(r"、")),
+    ("句点「．」", re.compile(r"．"), "句点「。」", re.compile(r"。")),
+    ("半角カナ", re.compile(r"[ｦ-ﾟ]"), "全角カナ", re.compile(r"[ァ-ヶ]")),
+]
+
+
+def load_typos(path):
+    typos = dict(DEFAULT_TYPOS)
+    if not path or not os.path.exists(path): return typos
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"): continue
+                parts = line.split()
+                typos[parts[0]] = parts[1] if len(parts) > 1 else ""
+    except Exception as e:
+        print(f"⚠️ 誤字辞書の読み込みエラー: {e}")
+    return typos
+
+
+class PreScreen:
+    """check(text) で怪しい箇所の一覧を返します。空ならAIに見せなくてもよさそうなページです"""
+
+    def __init__(self, typo_path=None):
+        self.typos = load_typos(typo_path)
+        # 辞書の単語は長いものから並べた1つの正規表現にまとめ、1回の走査で全部探します
+        words = sorted(self.typos, key=len, reverse=True)
+        self.typo_re = re.compile("|".join(re.escape(w) for w in words)) if words else None
+        self.pages = 0
+        self.flagged = 0
+
+    def check(self, text):
+        signals = []
+        for m in DOUBLED_PARTICLE.finditer(text):
+            signals.append(("助詞の重複", m.group(0)))
+        if self.typo_re:
+            for m in self.typo_re.finditer(text):
+                signals.append(("誤字の疑い", f"{m.group(0)}→{self.typos[m.group(0)]}"))
+        for name_a, re_a, name_b, re_b in WIDTH_PAIRS:
+            if re_a.search(text) and re_b.search(text):
+                signals.append(("全角半角の混在", f"{name_a}/{name_b}"))
+
+        self.pages += 1
+        if signals: self.flagged += 1
+        return signals
+
+    def is_suspicious(self, text):
+        return bool(self.check(text))
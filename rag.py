@@ -2,25 +2,219 @@ import os
 import glob
 import pickle
 import json
+import hashlib
 import numpy as np
 import faiss
 import shutil
-import tempfile
+import time
+import logging
+import threading
+import multiprocessing
+import llama_cpp
 from llama_cpp import Llama 
+from keyword_index import KeywordIndex
+from chunk_store import ChunkStore
+from metrics import METRICS
+
+log = logging.getLogger("rag")
+
+
+def _as_vector(raw_vec):
+    # poolingなしのモデルはトークンごとのリストが返るので先頭を使います
+    if raw_vec and isinstance(raw_vec[0], list): raw_vec = raw_vec[0]
+    return raw_vec
+
+
+def _group_by_budget(token_counts, max_tokens, max_items):
+    """トークン数の合計と件数の上限に収まるように (開始, 終了) の区間へ分けます"""
+    groups = []
+    start = 0
+    total = 0
+    for i, n in enumerate(token_counts):
+        if i > start and (total + n > max_tokens or i - start >= max_items):
+            groups.append((start, i))
+            start = i
+            total = 0
+        total += n
+    if start < len(token_counts): groups.append((start, len(token_counts)))
+    return groups
+
+
+def _embed_group(model, texts):
+    """まとめてベクトル化し、失敗したら1件ずつに切り替えます（失敗した所は None）"""
+    try:
+        res = model.create_embedding(texts)
+        rows = sorted(res['data'], key=lambda d: d.get('index', 0))
+        if len(rows) == len(texts):
+            return [_as_vector(r['embedding']) for r in rows], []
+    except Exception:
+        pass
+
+    vectors = []
+    errors = []
+    for i, text in enumerate(texts):
+        try:
+            res = model.create_embedding(text)
+            vectors.append(_as_vector(res['data'][0]['embedding']))
+        except Exception as e:
+            vectors.append(None)
+            errors.append((i, e))
+    return vectors, errors
+
+
+class _SharedEmbedder:
+    """
+    チャット用に読み込んだ Llama を、ベクトル化の間だけ embedding モードへ切り替えて使います。
+    同じモデルを2回読み込まないので、常駐メモリが半分で済みます。
+    """
+    def __init__(self, llm, lock):
+        self.llm = llm
+        self.lock = lock
+
+    @staticmethod
+    def supported():
+        return hasattr(llama_cpp, "llama_set_embeddings")
+
+    def _set_embeddings(self, flag):
+        llama_cpp.llama_set_embeddings(self.llm._ctx.ctx, flag)
+        self.llm.context_params.embeddings = flag
+
+    def create_embedding(self, texts):
+        with self.lock:
+            self._set_embeddings(True)
+            try:
+                return self.llm.create_embedding(texts)
+            finally:
+                self._set_embeddings(False)
+                # embedding でKVキャッシュが消えるので、生成側の記録もリセットしておきます
+                self.llm.reset()
+
+    def tokenize(self, data):
+        return self.llm.tokenize(data)
+
+    def n_embd(self):
+        return self.llm.n_embd()
+
+
+# ----------------------------------------------------------------
+# 検索インデックスの種類（config.json の index_type）
+#   flat     : 総当たり。正確だが件数に比例して遅くなる
+#   ivf_flat : クラスタに分けて nprobe 個だけ調べる
+#   hnsw     : グラフ探索。速いがメモリは多め（efSearch で精度調整）
+#   ivf_pq   : 直積量子化で圧縮。大規模向け、精度は少し落ちる
+#   sq_fp16  : float16 に圧縮した総当たり
+# ----------------------------------------------------------------
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq", "sq_fp16")
+
+def _auto_index_type(n):
+    if n < 20000: return "flat"
+    if n < 300000: return "ivf_flat"
+    return "ivf_pq"
+
+def _index_spec(kind, n, d):
+    """(実際に使う種類, index_factory の文字列) を返します。件数が少なすぎる場合は軽い種類に落とします"""
+    nlist = max(1, min(int(4 * np.sqrt(n)), n // 39))
+    if kind == "ivf_pq" and n < 10000: kind = "ivf_flat"
+    if kind in ("ivf_flat", "ivf_pq") and nlist < 4: kind = "flat"
+
+    if kind == "ivf_flat": return kind, f"IVF{nlist},Flat"
+    if kind == "ivf_pq":
+        m = max(i for i in range(1, 65) if d % i == 0)
+        return kind, f"IVF{nlist},PQ{m}x8"
+    if kind == "hnsw": return kind, "IDMap2,HNSW32,Flat"
+    if kind == "sq_fp16": return kind, "IDMap2,SQfp16"
+    return "flat", "IDMap2,Flat"
+
+def _build_index(kind, vectors, ids):
+    n, d = vectors.shape
+    kind, spec = _index_spec(kind, n, d)
+    index = faiss.index_factory(d, spec, faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        # 学習はサンプルで十分（大きすぎると時間だけかかる）
+        sample = vectors
+        if n > 100000:
+            sample = vectors[np.random.default_rng(0).choice(n, 100000, replace=False)]
+        index.train(np.ascontiguousarray(sample))
+    index.add_with_ids(np.ascontiguousarray(vectors), ids)
+    return kind, index
+
+def _set_search_params(index, nprobe=None, ef_search=None):
+    """nprobe (IVF系) と efSearch (HNSW) を設定します。対象外の種類では何もしません"""
+    ps = faiss.ParameterSpace()
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        if value is None: continue
+        try: ps.set_index_parameter(index, name, int(value))
+        except Exception: pass
+
+
+def _search_params(index, nprobe=None, ef_search=None):
+    """
+    その回の検索だけに使う nprobe / efSearch を返します（インデックス自体の設定は変えません）。
+    インデックスは全スレッドで共有しているので、_set_search_params で書き換えると他の検索にも効いてしまいます。
+    """
+    if nprobe is not None and faiss.try_extract_index_ivf(index) is not None:
+        return faiss.SearchParametersIVF(nprobe=int(nprobe))
+    inner = faiss.downcast_index(index.index) if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)) else index
+    if ef_search is not None and isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search))
+    return None
+
+
+# ----------------------------------------------------------------
+# 並列ベクトル化用のワーカー（プロセスごとに自分のモデルを持ちます）
+# ----------------------------------------------------------------
+_worker_model = None
+
+def _embed_worker_init(model_path, n_threads, batch_tokens):
+    global _worker_model
+    _worker_model = Llama(
+        model_path=model_path,
+        embedding=True,
+        verbose=False,
+        n_ctx=max(2048, batch_tokens),
+        n_batch=batch_tokens,
+        n_threads=n_threads,
+        n_gpu_layers=0
+    )
+
+def _embed_worker_run(task):
+    start, texts = task
+    vectors, errors = _embed_group(_worker_model, texts)
+    # 例外オブジェクトはプロセス間で送れないことがあるので文字列にします
+    return start, vectors, [(j, str(e)) for j, e in errors]
+
+
+class _DBState:
+    """1世代ぶんの知識DB。入れ替えは RAGManager.db への代入1回で行います"""
+    def __init__(self, generation=""):
+        self.generation = generation
+        self.index = None
+        self.store = None         # ChunkStore（チャンク本文と出典ファイル）
+        self.keyword = None
+        self.vectors = None       # 再利用・作り直し用に保存している生ベクトル
+        self.vector_ids = None
+        self.manifest = {}
+        self.db_error = ""
+
 
 class RAGManager:
     def __init__(self, base_dir):
         self.base_dir = base_dir
         self.knowledge_dir = os.path.join(base_dir, "knowledge")
         self.db_path = os.path.join(base_dir, "vector_db")
+        # DB作成の時間なども logs/trace.jsonl に記録します
+        METRICS.configure(os.path.join(base_dir, "logs"))
         
         self.config_path = os.path.join(base_dir, "config.json")
         self.model_path = ""
+        self.embed_path = ""
+        self.settings = {}
         
         if os.path.exists(self.config_path):
             try:
                 with open(self.config_path, "r", encoding="utf-8") as f:
                     cfg = json.load(f)
+                    self.settings = cfg
                     last_model = cfg.get("last_model", "")
                     if last_model:
                         self.model_path = os.path.join(base_dir, "gguf", last_model)
@@ -31,33 +225,112 @@ class RAGManager:
             if ggufs: self.model_path = ggufs[0]
             else: self.model_path = ""
 
+        # ---------------------------------------------------------
+        # ★検索専用の軽いモデル（config.json の embed_model）
+        # 指定が無ければチャット用のモデルを共有します（attach_model で受け取る）
+        # ---------------------------------------------------------
+        embed_name = self.settings.get("embed_model", "")
+        if embed_name:
+            path = embed_name if os.path.isabs(embed_name) else os.path.join(base_dir, "gguf", embed_name)
+            if os.path.exists(path): self.embed_path = path
+            else: print(f"警告: embed_model が見つかりません: {embed_name}（チャット用モデルを共有します）")
+
         if not os.path.exists(self.knowledge_dir): os.makedirs(self.knowledge_dir)
         if not os.path.exists(self.db_path): os.makedirs(self.db_path)
 
-        self.index = None
-        self.chunks = []
+        self.db = _DBState()
+        self._marked = set()   # このプロセスが in_use_<pid> の印を置いた世代
+        self._reloading = False
         self.embed_model = None 
+        self.embed_lock = threading.Lock()
         
         self.load_db()
 
+    # 読み込み中の世代への近道（読むだけ。入れ替えは self.db ごと行います）
+    @property
+    def index(self): return self.db.index
+    @property
+    def store(self): return self.db.store
+    @property
+    def keyword(self): return self.db.keyword
+    @property
+    def vectors(self): return self.db.vectors
+    @property
+    def vector_ids(self): return self.db.vector_ids
+    @property
+    def manifest(self): return self.db.manifest
+    @property
+    def db_error(self): return self.db.db_error
+
+    @property
+    def shares_chat_model(self):
+        return not self.embed_path
+
+    @property
+    def embeds_on_chat_engine(self):
+        """チャット用の Llama をそのまま借りてベクトル化しているか（生成中はベクトル化も待たされます）"""
+        return isinstance(self.embed_model, _SharedEmbedder)
+
+    def _embedding_path(self):
+        return self.embed_path or self.model_path
+
+    def embedding_model_name(self):
+        return os.path.basename(self._embedding_path())
+
+    def attach_model(self, llm, model_path, lock):
+        """
+        AIEngine が読み込んだチャット用 Llama を検索にも使います。
+        専用の embed_model が設定されている場合は何もしません。
+        """
+        if not self.shares_chat_model: return
+        if not _SharedEmbedder.supported():
+            print("警告: このllama_cppはモデル共有に未対応のため、検索用に別途読み込みます")
+            return
+        self.model_path = model_path
+        self.embed_model = _SharedEmbedder(llm, lock)
+        self._check_compat()
+
+    def _check_compat(self, db=None):
+        """DBを作ったモデル・次元と、今のembeddingモデルが一致しているか確認します"""
+        db = db or self.db
+        db.db_error = ""
+        if db.index is None: return
+        built_with = db.manifest.get("embed_model")
+        dimension = db.manifest.get("dimension", db.index.d)
+        current = self.embedding_model_name()
+
+        if built_with and current and built_with != current:
+            db.db_error = f"DBは {built_with} で作られています（現在: {current}）。DB更新が必要です。"
+        elif dimension != db.index.d:
+            db.db_error = f"DBの次元({db.index.d})がマニフェスト({dimension})と一致しません。DB更新が必要です。"
+        elif self.embed_model is not None and self.embed_model.n_embd() != db.index.d:
+            db.db_error = f"モデルの次元({self.embed_model.n_embd()})がDB({db.index.d})と一致しません。DB更新が必要です。"
+        if db.db_error: print(f"⚠️ {db.db_error}")
+
     def _load_model(self):
-        if not self.model_path or not os.path.exists(self.model_path):
+        path = self._embedding_path()
+        if not path or not os.path.exists(path):
             return "モデルファイルが見つかりません。config.jsonを確認してください。"
 
-        if self.embed_model is None:
-            m_name = os.path.basename(self.model_path)
-            print(f"Embeddingモデル読込中: {m_name}")
-            try:
-                self.embed_model = Llama(
-                    model_path=self.model_path,
-                    embedding=True,
-                    verbose=False,
-                    n_ctx=2048,
-                    n_threads=6,
-                    n_gpu_layers=0
-                )
-            except Exception as e:
-                return f"モデル読込エラー: {e}"
+        # チャットのワーカーが複数あると同時に呼ばれるので、読み込みは1回だけにします
+        with self.embed_lock:
+            if self.embed_model is None:
+                m_name = os.path.basename(path)
+                print(f"Embeddingモデル読込中: {m_name}")
+                try:
+                    batch_tokens = int(self.settings.get("embed_batch_tokens", 2048))
+                    self.embed_model = Llama(
+                        model_path=path,
+                        embedding=True,
+                        verbose=False,
+                        n_ctx=max(2048, batch_tokens),
+                        n_batch=batch_tokens,
+                        n_threads=6,
+                        n_gpu_layers=0
+                    )
+                except Exception as e:
+                    return f"モデル読込エラー: {e}"
+                self._check_compat()
         return None
 
     def _normalize(self, vec):
@@ -65,7 +338,94 @@ class RAGManager:
         if norm == 0: return vec
         return vec / norm
 
-    def build_database(self, callback=None):
+    def _embed_texts(self, texts, report=None, parallel=False):
+        """
+        テキストをまとめてベクトル化し、(float32行列, 成功フラグ) を返します。
+        トークン数(embed_batch_tokens)と件数(embed_batch_size)の上限ごとに束ねて投げます。
+        parallel=True（DB作成とベンチマークだけ）の時は embed_workers の複数プロセスを使います。
+        検索は常に読み込み済みのモデルで行います（質問のたびにプロセスとモデルを用意しないように）。
+        """
+        max_tokens = int(self.settings.get("embed_batch_tokens", 2048))
+        max_items = int(self.settings.get("embed_batch_size", 32))
+
+        token_counts = []
+        for t in texts:
+            try: token_counts.append(len(self.embed_model.tokenize(t.encode("utf-8"))))
+            except Exception: token_counts.append(max_tokens)
+
+        matrix = np.zeros((len(texts), self.embed_model.n_embd()), dtype='float32')
+        ok = np.zeros(len(texts), dtype=bool)
+
+        groups = _group_by_budget(token_counts, max_tokens, max_items)
+        done = 0
+        next_report = 5
+        for start, vectors, errors in self._run_groups(texts, groups, parallel):
+            end = start + len(vectors)
+            for j, vec in enumerate(vectors):
+                if vec is None: continue
+                matrix[start + j] = vec
+                ok[start + j] = True
+            for j, e in errors:
+                if report: report(f"Error chunk {start + j}: {e}")
+
+            done = end
+            if report and (done >= next_report or done == len(texts)):
+                report(f"進捗: {done}/{len(texts)} 完了")
+                next_report = done + 5
+        return matrix, ok
+
+    def _run_groups(self, texts, groups, parallel=False):
+        """
+        束ごとにベクトル化して (開始位置, ベクトル一覧, エラー一覧) を元の順番で返します。
+        parallel=True で config.json の embed_workers が2以上なら、CPUスレッドを分け合う複数プロセスで処理します。
+        """
+        workers = int(self.settings.get("embed_workers", 1)) if parallel else 1
+        workers = min(workers, len(groups))
+        if workers <= 1:
+            for start, end in groups:
+                with self.embed_lock:
+                    result = _embed_group(self.embed_model, texts[start:end])
+                yield (start,) + result
+            return
+
+        batch_tokens = int(self.settings.get("embed_batch_tokens", 2048))
+        threads = max(1, (os.cpu_count() or workers) // workers)
+        print(f"並列ベクトル化: {workers}プロセス x {threads}スレッド")
+
+        tasks = [(start, texts[start:end]) for start, end in groups]
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(workers, initializer=_embed_worker_init,
+                      initargs=(self._embedding_path(), threads, batch_tokens)) as pool:
+            # imap は投入した順に結果を返すので、並び順はそのまま保たれます
+            for result in pool.imap(_embed_worker_run, tasks):
+                yield result
+
+    def _file_hash(self, file_path):
+        h = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def _split_chunks(self, text, filename):
+        chunk_size = 600
+        overlap = 100
+        chunks = []
+        for i in range(0, len(text), chunk_size - overlap):
+            chunk_text = text[i : i + chunk_size].strip()
+            if len(chunk_text) > 20:
+                chunks.append(f"【出典:{filename}】\n{chunk_text}")
+        return chunks
+
+    def build_database(self, callback=None, full=False):
+        """full=True なら前回のベクトルを使わず全件作り直します"""
+        trace = METRICS.start("build")
+        try:
+            return self._build_database(callback, full)
+        finally:
+            METRICS.finish(trace)
+
+    def _build_database(self, callback=None, full=False):
         def report(msg):
             print(msg)
             if callback: callback(msg)
@@ -82,181 +442,567 @@ class RAGManager:
         for f in files: report(f" - {os.path.basename(f)}")
         report("-" * 20)
 
-        new_chunks = []
+        # ---------------------------------------------------------
+        # ★差分更新：前回のマニフェスト（ファイルごとのハッシュとベクトルID）と比較
+        # 生ベクトルが読めている時だけ、前回のベクトルを再利用します
+        # ---------------------------------------------------------
+        db = self.db
+        old_files = db.manifest.get("files", {})
+        # 作成時とモデルが違う場合(db_error)は再利用せず全件作り直します
+        can_reuse = not full and db.vectors is not None and bool(old_files) and not db.db_error
+        if not can_reuse: old_files = {}
+
+        next_id = db.manifest.get("next_id", 0) if can_reuse else 0
+        new_manifest_files = {}
+        new_chunks = []       # (vector_id, chunk_text, filename)
+        reused_count = 0
+        seen = set()
+        t_scan = time.perf_counter()
+
         for file_path in files:
+            filename = os.path.basename(file_path)
+            seen.add(filename)
+            try:
+                digest = self._file_hash(file_path)
+            except: continue
+
+            prev = old_files.get(filename)
+            if prev and prev.get("hash") == digest:
+                new_manifest_files[filename] = prev
+                reused_count += len(prev.get("ids", []))
+                continue
+
             try:
                 with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
                     text = f.read()
-                    filename = os.path.basename(file_path)
-                    
-                    chunk_size = 600
-                    overlap = 100
-                    
-                    for i in range(0, len(text), chunk_size - overlap):
-                        chunk_text = text[i : i + chunk_size].strip()
-                        if len(chunk_text) > 20:
-                            new_chunks.append(f"【出典:{filename}】\n{chunk_text}")
-            except: pass
+            except: continue
 
-        if not new_chunks: return "有効なテキストがありませんでした"
+            chunks = self._split_chunks(text, filename)
+            for chunk in chunks:
+                new_chunks.append((next_id, chunk, filename))
+                next_id += 1
+            new_manifest_files[filename] = {"hash": digest, "ids": []}
 
-        embeddings = []
-        report(f"ベクトル化開始 ({len(new_chunks)}件)...")
-        
-        for i, chunk in enumerate(new_chunks):
-            try:
-                vec = self.embed_model.create_embedding(chunk)
-                raw_vec = vec['data'][0]['embedding']
-                if isinstance(raw_vec[0], list): raw_vec = raw_vec[0]
-                
-                # 正規化しないでそのまま入れる（Faissに任せる）
-                # Elyzaなどのモデルは値が大きいため、ここで下手にいじると情報が消える可能性がある
-                embeddings.append(raw_vec)
-                
-            except Exception as e:
-                report(f"Error chunk {i}: {e}")
-            
-            if (i+1) % 5 == 0: 
-                report(f"進捗: {i+1}/{len(new_chunks)} 完了")
+        METRICS.observe("scan", time.perf_counter() - t_scan)
 
-        if not embeddings: return "ベクトル化失敗"
+        # 変更・削除されたファイルの古いベクトルIDを集める
+        stale_ids = []
+        for filename, prev in old_files.items():
+            if filename not in seen or new_manifest_files.get(filename) is not prev:
+                stale_ids.extend(prev.get("ids", []))
 
-        np_embeddings = np.array(embeddings, dtype='float32')
-        dimension = np_embeddings.shape[1]
+        # index_type を変えた時は、ファイルに変更が無くてもインデックスだけ作り直します
+        wanted_type = self.settings.get("index_type", "auto")
+        if not new_chunks and not stale_ids and can_reuse:
+            kind = wanted_type if wanted_type in INDEX_TYPES else _auto_index_type(reused_count)
+            if _index_spec(kind, reused_count, db.index.d)[0] == db.manifest.get("index_type", "flat"):
+                final_msg = f"変更なし（再利用 {reused_count}件 / 再計算 0件）"
+                report(final_msg)
+                return final_msg
 
-        # 内積(IP)検索
-        self.index = faiss.IndexFlatIP(dimension)
-        self.index.add(np_embeddings)
-        self.chunks = new_chunks
+        if not new_chunks and not new_manifest_files: return "有効なテキストがありませんでした"
 
-        if not os.path.exists(self.db_path): os.makedirs(self.db_path)
+        report(f"ベクトル化開始 ({len(new_chunks)}件 / 再利用 {reused_count}件)...")
         
+        # 正規化しないでそのまま入れる（Faissに任せる）
+        # Elyzaなどのモデルは値が大きいため、ここで下手にいじると情報が消える可能性がある
+        t_start = time.perf_counter()
+        matrix, ok = self._embed_texts([c for _, c, _ in new_chunks], report, parallel=True)
+        elapsed = time.perf_counter() - t_start
+        METRICS.observe("embed", elapsed)
+        METRICS.count("chunks_embedded", int(ok.sum()))
+        METRICS.count("chunks_reused", reused_count)
+
+        ok_ids = []
+        for (vid, _, filename), good in zip(new_chunks, ok):
+            if not good: continue
+            ok_ids.append(vid)
+            new_manifest_files[filename]["ids"].append(vid)
+        np_embeddings = matrix[ok]
+
+        if new_chunks:
+            rate = len(new_chunks) / elapsed if elapsed > 0 else 0.0
+            report(f"スループット: {rate:.2f} chunks/s ({len(new_chunks)}件 / {elapsed:.1f}秒, batch={self.settings.get('embed_batch_size', 32)}, workers={self.settings.get('embed_workers', 1)})")
+
+        if new_chunks and not ok_ids and not reused_count: return "ベクトル化失敗"
+
+        # 保存してある生ベクトルから、消すものを除いて新しいものを足します
+        if can_reuse:
+            keep = ~np.isin(db.vector_ids, np.array(stale_ids, dtype='int64'))
+            old_vectors = np.asarray(db.vectors)[keep]
+            old_ids = np.asarray(db.vector_ids)[keep]
+        else:
+            old_vectors = np.zeros((0, np_embeddings.shape[1]), dtype='float32')
+            old_ids = np.zeros(0, dtype='int64')
+        if old_vectors.shape[1] != np_embeddings.shape[1]:
+            report("ベクトル次元が前回と異なるため、全件作り直します")
+            return self._build_database(callback, full=True)
+
+        vectors = np.vstack([old_vectors, np_embeddings]).astype('float32')
+        vector_ids = np.concatenate([old_ids, np.array(ok_ids, dtype='int64')])
+        if not len(vector_ids): return "ベクトル化失敗"
+
+        # 内積(IP)検索。ファイル単位で消せるように ID 付きで登録します
+        t_start = time.perf_counter()
+        if wanted_type not in INDEX_TYPES: wanted_type = _auto_index_type(len(vector_ids))
+        index_type, index = _build_index(wanted_type, vectors, vector_ids)
+        _set_search_params(index, self.settings.get("nprobe", 16), self.settings.get("ef_search", 64))
+        METRICS.observe("index", time.perf_counter() - t_start)
+        report(f"インデックス作成: {index_type} ({len(vector_ids)}件, {time.perf_counter() - t_start:.1f}秒)")
+
+        # 本文は再利用分を今のストアから読み出し、新しい分と合わせて書き出します
+        records = list(db.store.records(old_ids)) if can_reuse else []
+        ok_set = set(ok_ids)
+        records.extend(r for r in new_chunks if r[0] in ok_set)
+
+        # キーワード索引はチャンク本文から作り直します（ベクトル化に比べれば一瞬です）
+        with METRICS.stage("keyword_index"):
+            keyword = KeywordIndex.build((vid, text) for vid, text, _ in records)
+
+        manifest = {
+            "version": 1,
+            "embed_model": self.embedding_model_name(),
+            "dimension": index.d,
+            "index_type": index_type,
+            "next_id": next_id,
+            "files": new_manifest_files,
+        }
+
+        # ---------------------------------------------------------
+        # ★新しい世代フォルダに全部書き出してから、CURRENT の1回の置き換えで公開します
+        # 読む側（Watcher等）が、索引と本文の食い違った組み合わせを見ることはありません
+        # ---------------------------------------------------------
+        t_start = time.perf_counter()
         try:
-            fd, temp_path = tempfile.mkstemp(suffix=".faiss")
-            os.close(fd)
-            faiss.write_index(self.index, temp_path)
-            
-            target_path = os.path.join(self.db_path, "index.faiss")
-            if os.path.exists(target_path): os.remove(target_path)
-            shutil.move(temp_path, target_path)
-            
-            with open(os.path.join(self.db_path, "chunks.pkl"), "wb") as f:
-                pickle.dump(self.chunks, f)
+            gen_dir = self._new_generation_dir()
+            faiss.write_index(index, os.path.join(gen_dir, "index.faiss"))
+            ChunkStore.write(gen_dir, records)
+            np.save(os.path.join(gen_dir, "vectors.npy"), vectors)
+            np.save(os.path.join(gen_dir, "vector_ids.npy"), vector_ids)
+            keyword.save(gen_dir)
+            with open(os.path.join(gen_dir, "manifest.json"), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            self._publish_generation(os.path.basename(gen_dir))
         except Exception as e:
             msg = f"保存エラー: {e}"
             report(msg)
             return msg
 
-        final_msg = f"完了！ {len(new_chunks)}件処理しました。"
+        self._switch_db(self._open_generation(os.path.basename(gen_dir)))
+        self._prune_generations()
+        METRICS.observe("save", time.perf_counter() - t_start)
+
+        final_msg = f"完了！ 再利用 {reused_count}件 / 再計算 {len(ok_ids)}件（削除 {len(stale_ids)}件）"
         report(final_msg)
         return final_msg
 
     # ----------------------------------------------------------------
     # ★超・強化版ハイブリッド検索
     # ----------------------------------------------------------------
-    def get_context(self, query):
-        if self.index is None or not self.chunks: return "", []
+    def get_context(self, query, nprobe=None, ef_search=None):
+        """nprobe / ef_search を渡すと、その回の検索だけ精度と速度の設定を変えます"""
+        return self.get_contexts([query], nprobe, ef_search)[0]
+
+    def get_contexts(self, queries, nprobe=None, ef_search=None):
+        """
+        複数の質問をまとめて検索し、質問ごとの (参照テキスト, 出典ファイル一覧) を同じ順番で返します。
+        ベクトル化は1回の呼び出しに束ね、FAISS の検索も全質問ぶんを1回で行います。
+        """
+        empty = [("", []) for _ in queries]
+        if not queries: return empty
+        # 途中で世代が入れ替わっても、この検索は最後まで同じ世代を使います
+        db = self.db
+        store = db.store
+        if db.index is None or not store: return empty
         err = self._load_model()
         if err: 
             print(f"RAG Error: {err}")
-            return "", []
+            return empty
+        # 別モデルで作られたDBから検索すると的外れな結果になるので使いません
+        if db.db_error: return empty
 
         try:
-            # 1. ベクトル検索
-            vec_res = self.embed_model.create_embedding(query)
-            query_vec = vec_res['data'][0]['embedding']
-            if isinstance(query_vec[0], list): query_vec = query_vec[0]
-            
-            np_query = np.array([query_vec], dtype='float32')
+            # 1. ベクトル検索（全質問まとめて）
+            with METRICS.stage("embed"):
+                np_query, ok = self._embed_texts(list(queries))
             
+            # 共有のインデックスは書き換えず、この検索にだけ設定を渡します
+            params = _search_params(db.index, nprobe, ef_search) if nprobe is not None or ef_search is not None else None
+
             # 多めに候補を取る
             search_k = 50
-            if search_k > len(self.chunks): search_k = len(self.chunks)
-            
-            distances, indices = self.index.search(np_query, search_k)
-            
-            # 2. スコア調整（キーワード一致の爆上げ）
-            # 質問文から、意味のありそうな文字だけを抽出（ひらがな1文字などはノイズになりやすいが、今回は単純化）
-            # 重複を除いた文字セットを作る
-            q_chars = list(set(query.replace(" ", "").replace("　", "")))
-            
-            scored_chunks = []
-            
-            print(f"\n--- スコア計算内訳 (Base -> Bonus) ---")
+            if search_k > db.index.ntotal: search_k = db.index.ntotal
             
-            for i, vector_score in zip(indices[0], distances[0]):
-                if i < len(self.chunks) and i >= 0:
-                    chunk = self.chunks[i]
-                    
-                    # ★ここを変更：単純に「含まれている文字数」をカウントする
-                    match_count = 0
-                    matched_chars = []
-                    for char in q_chars:
-                        if char in chunk:
-                            match_count += 1
-                            matched_chars.append(char)
-                    
-                    # ★ボーナス計算
-                    # 1文字ヒットするごとに「500点」加算します。
-                    # これなら 19559点 vs 19560点 の僅差を一撃でひっくり返せます。
-                    bonus_score = match_count * 500.0
-                    
-                    final_score = vector_score + bonus_score
-                    
-                    # ログ出し（デバッグ用）
-                    fname = chunk.split("【出典:")[1].split("】")[0]
-                    if match_count > 0 and len(scored_chunks) < 10:
-                        print(f"[{fname[:5]}...] Vec:{vector_score:.1f} + Bonus:{bonus_score:.0f} (Match:{''.join(matched_chars)})")
-
-                    scored_chunks.append({
-                        "chunk": chunk,
-                        "score": final_score,
-                        "fname": fname
-                    })
-            
-            # 3. 並べ替え
-            scored_chunks.sort(key=lambda x: x["score"], reverse=True)
-            
-            # 4. 採用
-            results = []
-            source_files = []
-            file_counts = {}
-            
-            print(f"\n--- 最終検索結果 (Top 6) ---")
-            for item in scored_chunks:
-                fname = item["fname"]
-                count = file_counts.get(fname, 0)
-                if count >= 3: continue 
-                
-                results.append(item["chunk"])
-                if fname not in source_files: source_files.append(fname)
-                file_counts[fname] = count + 1
-                
-                print(f"・Total: {item['score']:.1f} | {fname}")
-                
-                if len(results) >= 6: break
-            print("--------------------------------\n")
-
-            if results:
-                context_text = "\n\n".join(results)
-                formatted = f"\n\n### 🧠 知識データベース参照 ###\n{context_text}\n#############################\n"
-                return formatted, source_files
+            with METRICS.stage("search"):
+                distances, indices = db.index.search(np_query, search_k, params=params)
         except Exception as e:
             print(f"検索エラー: {e}")
+            return empty
+
+        results = []
+        for n, query in enumerate(queries):
+            if not ok[n]:
+                results.append(("", []))
+                continue
+            try:
+                results.append(self._fuse(db, query, distances[n], indices[n], search_k))
+            except Exception as e:
+                print(f"検索エラー: {e}")
+                results.append(("", []))
+        return results
+
+    def _fuse(self, db, query, distances, indices, search_k):
+        """1つの質問について、ベクトル検索の結果とキーワード検索を混ぜて参照テキストを作ります"""
+        store = db.store
+
+        # 2. キーワード検索（全チャンク対象の BM25）
+        # ベクトル検索の上位50件に入っていない完全一致も拾えます
+        t_start = time.perf_counter()
+        keyword_hits = db.keyword.search(query, k=search_k) if db.keyword else []
+        METRICS.observe("keyword", time.perf_counter() - t_start)
+
+        # 3. 順位の融合（Reciprocal Rank Fusion）
+        # スコアの尺度が違う2つの検索を、順位だけで公平に混ぜます
+        rrf_k = 60.0
+        fused = {}
+        vec_scores = {}
+        for rank, (i, vector_score) in enumerate(zip(indices, distances)):
+            if i < 0: continue
+            i = int(i)
+            fused[i] = fused.get(i, 0.0) + 1.0 / (rrf_k + rank + 1)
+            vec_scores[i] = float(vector_score)
+        kw_scores = {}
+        for rank, (i, kw_score) in enumerate(keyword_hits):
+            fused[i] = fused.get(i, 0.0) + 1.0 / (rrf_k + rank + 1)
+            kw_scores[i] = kw_score
+
+        # 4. 並べ替え
+        ranked = sorted(fused.items(), key=lambda x: x[1], reverse=True)
+        
+        # ログ出し（デバッグ用。config.json の log_level を DEBUG にすると表示されます）
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug(f"\n--- スコア計算内訳 (Vec / BM25 -> RRF) ---")
+            for i, score in ranked[:10]:
+                fname = store.source(i) or "?"
+                log.debug(f"[{fname[:5]}...] Vec:{vec_scores.get(i, 0.0):.1f} / BM25:{kw_scores.get(i, 0.0):.2f} -> {score:.4f}")
+        
+        # 5. 採用（本文は採用したチャンクだけ読みます）
+        results = []
+        source_files = []
+        file_counts = {}
         
+        if debug: log.debug(f"\n--- 最終検索結果 (Top 6) ---")
+        for i, score in ranked:
+            fname = store.source(i)
+            if fname is None: continue
+            count = file_counts.get(fname, 0)
+            if count >= 3: continue 
+            
+            results.append(store.get(i))
+            if fname not in source_files: source_files.append(fname)
+            file_counts[fname] = count + 1
+            
+            if debug: log.debug(f"・Total: {score:.4f} | {fname}")
+            
+            if len(results) >= 6: break
+        if debug: log.debug("--------------------------------\n")
+
+        if results:
+            context_text = "\n\n".join(results)
+            formatted = f"\n\n### 🧠 知識データベース参照 ###\n{context_text}\n#############################\n"
+            return formatted, source_files
         return "", []
 
+    def benchmark_embedding(self, worker_counts, sample=200):
+        """知識フォルダのチャンクを使い、プロセス数ごとの chunks/s を比べます（DBは書き換えません）"""
+        err = self._load_model()
+        if err: return err
+
+        texts = []
+        for file_path in glob.glob(os.path.join(self.knowledge_dir, "*.txt")):
+            try:
+                with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+                    texts.extend(self._split_chunks(f.read(), os.path.basename(file_path)))
+            except: pass
+            if len(texts) >= sample: break
+        texts = texts[:sample]
+        if not texts: return "知識ファイル(.txt)がありません"
+
+        original = self.settings.get("embed_workers", 1)
+        results = []
+        try:
+            for n in worker_counts:
+                self.settings["embed_workers"] = n
+                t_start = time.perf_counter()
+                self._embed_texts(texts, parallel=True)
+                elapsed = time.perf_counter() - t_start
+                rate = len(texts) / elapsed if elapsed > 0 else 0.0
+                results.append((n, rate))
+                print(f"workers={n}: {rate:.2f} chunks/s ({len(texts)}件 / {elapsed:.1f}秒)")
+        finally:
+            self.settings["embed_workers"] = original
+        return results
+
+    def benchmark_index(self, kinds=INDEX_TYPES, k=10, n_queries=200, nprobes=(4, 16, 64), ef_searches=(32, 64, 128)):
+        """
+        保存済みのベクトルで各インデックスを作り、総当たり(flat)に対する recall@k と
+        1問あたりの検索時間を比べます。クエリはDB内のベクトルから抜き出すので、現在のDBは変わりません。
+        """
+        if self.vectors is None or not len(self.vectors): return "ベクトルが保存されていません。DB更新を実行してください。"
+        vectors = np.ascontiguousarray(self.vectors, dtype='float32')
+        ids = np.asarray(self.vector_ids, dtype='int64')
+        rng = np.random.default_rng(0)
+        queries = vectors[rng.choice(len(vectors), min(n_queries, len(vectors)), replace=False)]
+        k = min(k, len(vectors))
+
+        _, exact = _build_index("flat", vectors, ids)
+        _, truth = exact.search(queries, k)
+
+        rows = []
+        print(f"{'index':<10} {'param':<14} {'recall@'+str(k):>10} {'ms/query':>10} {'build s':>8}")
+        for kind in kinds:
+            t_start = time.perf_counter()
+            actual, index = _build_index(kind, vectors, ids)
+            build_sec = time.perf_counter() - t_start
+            if actual in ("ivf_flat", "ivf_pq"): params = [("nprobe", v) for v in nprobes]
+            elif actual == "hnsw": params = [("efSearch", v) for v in ef_searches]
+            else: params = [("-", None)]
+
+            for name, value in params:
+                if name == "nprobe": _set_search_params(index, nprobe=value)
+                elif name == "efSearch": _set_search_params(index, ef_search=value)
+                t_start = time.perf_counter()
+                _, found = index.search(queries, k)
+                ms = (time.perf_counter() - t_start) * 1000 / len(queries)
+                recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+                label = f"{name}={value}" if value is not None else "-"
+                rows.append((actual, label, recall, ms, build_sec))
+                print(f"{actual:<10} {label:<14} {recall:>10.3f} {ms:>10.3f} {build_sec:>8.1f}")
+        return rows
+
     def open_folder(self): os.startfile(self.knowledge_dir)
     def load_user_file(self, path):
         try:
             with open(path, "r", encoding="utf-8", errors="ignore") as f: return f.read()
         except: return None
+    def _read_index(self, path):
+        # 対応している種類なら mmap で開き、起動時に全体を読み込まないようにします
+        flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+        try: return faiss.read_index(path, flags)
+        except Exception: return faiss.read_index(path)
+
+    def _migrate_pickle(self, db_dir):
+        """旧形式の chunks.pkl をチャンクストアに変換します（初回だけ）"""
+        with open(os.path.join(db_dir, "chunks.pkl"), "rb") as f: chunks = pickle.load(f)
+        # 旧形式（リスト）は連番IDとして扱います
+        if isinstance(chunks, list): chunks = dict(enumerate(chunks))
+        records = []
+        for vid, text in chunks.items():
+            fname = text.split("【出典:")[1].split("】")[0] if "【出典:" in text else ""
+            records.append((vid, text, fname))
+        ChunkStore.write(db_dir, records)
+        print("chunks.pkl をチャンクストアに変換しました")
+
+    # ----------------------------------------------------------------
+    # 世代管理：vector_db/gen_XXXXXX/ に1世代ずつ保存し、CURRENT に今の世代名を書きます
+    # CURRENT が無い場合は、vector_db 直下の旧形式ファイルを読みます
+    # ----------------------------------------------------------------
+    def current_generation(self):
+        try:
+            with open(os.path.join(self.db_path, "CURRENT"), "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except Exception:
+            return ""
+
+    def _new_generation_dir(self):
+        if not os.path.exists(self.db_path): os.makedirs(self.db_path)
+        nums = [int(n[4:]) for n in os.listdir(self.db_path) if n.startswith("gen_") and n[4:].isdigit()]
+        num = max(nums, default=0) + 1
+        while True:
+            path = os.path.join(self.db_path, f"gen_{num:06d}")
+            try:
+                os.makedirs(path)
+                return path
+            except FileExistsError:
+                num += 1
+
+    def _publish_generation(self, name):
+        # 同じフォルダ内の os.replace は原子的なので、読む側は古いか新しいかのどちらかしか見ません
+        tmp = os.path.join(self.db_path, f"CURRENT.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.db_path, "CURRENT"))
+
+    def _switch_db(self, db):
+        """
+        self.db を入れ替え、使っている世代フォルダに in_use_<pid> の印を置きます。
+        入れ替え直後は古い世代を使い終わっていない検索があるので、1つ前の世代の印も残し、2つ前の印を外します。
+        """
+        previous = self.db
+        self.db = db
+        for gen in (db.generation, previous.generation):
+            if gen: self._mark_in_use(gen, True)
+        for gen in self._marked:
+            if gen not in (db.generation, previous.generation): self._mark_in_use(gen, False)
+        self._marked = {g for g in (db.generation, previous.generation) if g}
+
+    def _mark_in_use(self, generation, on):
+        path = os.path.join(self.db_path, generation, f"in_use_{os.getpid()}")
+        try:
+            if on:
+                with open(path, "w", encoding="utf-8"): pass
+            elif os.path.exists(path):
+                os.remove(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _pid_alive(pid):
+        if pid == os.getpid(): return True
+        if os.name == "nt":
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            handle = kernel32.OpenProcess(0x1000, False, pid)   # PROCESS_QUERY_LIMITED_INFORMATION
+            if not handle: return False
+            code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+            kernel32.CloseHandle(handle)
+            return code.value == 259   # STILL_ACTIVE
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def _in_use(self, gen_dir):
+        """生きているプロセス（GUI・Watcher）の印が残っている世代か。落ちたプロセスの印はここで消します"""
+        used = False
+        try: names = os.listdir(gen_dir)
+        except OSError: return False
+        for name in names:
+            if not name.startswith("in_use_") or not name[7:].isdigit(): continue
+            if self._pid_alive(int(name[7:])):
+                used = True
+            else:
+                try: os.remove(os.path.join(gen_dir, name))
+                except OSError: pass
+        return used
+
+    def _prune_generations(self):
+        """
+        古い世代を消します。どれかのプロセスが in_use_<pid> の印を置いている世代（と CURRENT）は残します。
+        消す前にフォルダ名を変えてみて、開かれたままで変えられない時（Windows）は次回に回します（消しかけを残さないため）。
+        """
+        keep = int(self.settings.get("db_keep_generations", 3))
+        names = os.listdir(self.db_path)
+        for name in names:
+            # 前回消しきれなかったもの
+            if name.startswith("del_gen_"): shutil.rmtree(os.path.join(self.db_path, name), ignore_errors=True)
+        gens = sorted(n for n in names if n.startswith("gen_"))
+        for name in gens[:-keep] if keep > 0 else gens:
+            if name in (self.db.generation, self.current_generation()): continue
+            path = os.path.join(self.db_path, name)
+            if self._in_use(path): continue
+            trash = os.path.join(self.db_path, "del_" + name)
+            try:
+                os.rename(path, trash)
+            except OSError:
+                continue
+            shutil.rmtree(trash, ignore_errors=True)
+
+    def _open_generation(self, generation):
+        """1世代ぶんを読み込んで _DBState を返します（self.db は書き換えません）"""
+        db = _DBState(generation)
+        db_dir = os.path.join(self.db_path, generation) if generation else self.db_path
+        idx = os.path.join(db_dir, "index.faiss")
+        if not os.path.exists(idx): return db
+        if not ChunkStore.exists(db_dir):
+            if not os.path.exists(os.path.join(db_dir, "chunks.pkl")): return db
+            self._migrate_pickle(db_dir)
+
+        db.index = self._read_index(idx)
+        db.store = ChunkStore.open(db_dir)
+        man = os.path.join(db_dir, "manifest.json")
+        if os.path.exists(man):
+            with open(man, "r", encoding="utf-8") as f: db.manifest = json.load(f)
+
+        kw = os.path.join(db_dir, "keyword.pkl")
+        if KeywordIndex.exists(db_dir):
+            db.keyword = KeywordIndex.load(db_dir)
+        elif os.path.exists(kw):
+            # 以前の形式（pickle）は1回だけ読んで、次からは mmap で開けるように書き出しておきます
+            db.keyword = KeywordIndex.load_pickle(kw)
+            try: db.keyword.save(db_dir)
+            except OSError: pass
+        else:
+            # 旧形式のDBは、起動時にメモリ上だけで作ります
+            db.keyword = KeywordIndex.build((vid, text) for vid, text, _ in db.store.records())
+
+        vec = os.path.join(db_dir, "vectors.npy")
+        vid = os.path.join(db_dir, "vector_ids.npy")
+        if os.path.exists(vec) and os.path.exists(vid):
+            db.vectors = np.load(vec, mmap_mode="r")
+            db.vector_ids = np.load(vid)
+        else:
+            # 生ベクトルを保存していない旧DBは、Flatインデックスから取り出します
+            try:
+                if isinstance(db.index, faiss.IndexIDMap2):
+                    db.vector_ids = faiss.vector_to_array(db.index.id_map).astype('int64')
+                    db.vectors = db.index.index.reconstruct_n(0, db.index.ntotal)
+                elif isinstance(db.index, faiss.IndexFlat):
+                    db.vector_ids = np.arange(db.index.ntotal, dtype='int64')
+                    db.vectors = db.index.reconstruct_n(0, db.index.ntotal)
+            except Exception:
+                db.vectors = db.vector_ids = None
+
+        _set_search_params(db.index, self.settings.get("nprobe", 16), self.settings.get("ef_search", 64))
+        self._check_compat(db)
+        return db
+
     def load_db(self):
         try:
-            idx = os.path.join(self.db_path, "index.faiss")
-            chk = os.path.join(self.db_path, "chunks.pkl")
-            if os.path.exists(idx) and os.path.exists(chk):
-                self.index = faiss.read_index(idx)
-                with open(chk, "rb") as f: self.chunks = pickle.load(f)
-                print("DB読込完了")
-        except: pass
+            self._switch_db(self._open_generation(self.current_generation()))
+            if self.db.index is not None: print(f"DB読込完了 ({self.db.generation or '旧形式'})")
+        except Exception as e:
+            print(f"DB読込エラー: {e}")
+
+    def reload_if_changed(self, background=True):
+        """
+        CURRENT が指す世代が変わっていたら読み込み直します。
+        background=True なら別スレッドで読み込み、読み終わった時点で self.db を差し替えます。
+        その間に来た検索は、古い世代のまま止まらずに処理されます。
+        """
+        generation = self.current_generation()
+        if generation == self.db.generation or self._reloading: return False
+
+        def _load():
+            try:
+                db = self._open_generation(generation)
+                if db.index is not None:
+                    self._switch_db(db)
+                    print(f"🔄 知識DBを新しい世代に切り替えました: {generation}")
+            except Exception as e:
+                print(f"DB再読込エラー: {e}")
+            finally:
+                self._reloading = False
+
+        self._reloading = True
+        if background: threading.Thread(target=_load, daemon=True).start()
+        else: _load()
+        return True
+
+
+if __name__ == "__main__":
+    # 例: python rag.py bench-embed 1 4 8
+    #     python rag.py bench-index
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench-embed":
+        counts = [int(a) for a in sys.argv[2:]] or [1, max(1, (os.cpu_count() or 2) // 4)]
+        RAGManager(os.path.dirname(os.path.abspath(__file__))).benchmark_embedding(counts)
+    elif len(sys.argv) >= 2 and sys.argv[1] == "bench-index":
+        RAGManager(os.path.dirname(os.path.abspath(__file__))).benchmark_index()
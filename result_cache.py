@@ -0,0 +1,100 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+def make_key(*parts):
+    """キーの材料（テキスト・モデル・プロンプトなど）をまとめて1つのハッシュにします"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def model_fingerprint(model_path):
+    """同じ名前で中身を入れ替えた時も別物になるよう、サイズと更新時刻も混ぜます"""
+    try:
+        st = os.stat(model_path)
+        return f"{os.path.basename(model_path)}:{st.st_size}:{int(st.st_mtime)}"
+    except OSError:
+        return os.path.basename(model_path or "")
+
+
+class ResultCache:
+    """
+    生成結果を保存しておく SQLite のキャッシュ。
+    件数が max_entries を超えたら最後に使われたのが古いものから捨てます（ttl 秒を過ぎたものも使いません）。
+    上限の確認は50件書き込むごとなので、その間は少しだけ上限を超えることがあります。
+    複数のワーカースレッドから使えるよう、呼び出しはロックで直列化します。
+    """
+
+    def __init__(self, path, max_entries=5000, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._puts = 0
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder): os.makedirs(folder)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results(last_used)")
+        self._db.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM results WHERE key=?", (key,)).fetchone()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE results SET last_used=? WHERE key=?", (now, key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results(key, value, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, now, now))
+            self._puts += 1
+            # 毎回数えると遅いので、ある程度書き込んだら上限を超えた分を捨てます
+            if self._puts % 50 == 1: self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now):
+        if self.ttl:
+            self._db.execute("DELETE FROM results WHERE created < ?", (now - self.ttl,))
+        count = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self),
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
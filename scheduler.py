@@ -0,0 +1,288 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+from metrics import METRICS
+
+
+class Request:
+    """exchange_box に置かれた1件の依頼（req_*.txt / req_*.pdf）"""
+
+    def __init__(self, path, priority=0):
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.uid = self.filename.replace("req_", "").replace(".txt", "").replace(".pdf", "")
+        self.ext = os.path.splitext(self.filename)[1].lower()
+        self.lane = "pdf" if self.ext == ".pdf" else "chat"
+        self.priority = priority
+        try: self.ctime = os.path.getctime(path)
+        except OSError: self.ctime = time.time()
+        self.enqueued_at = time.time()
+        self.started_at = None
+
+
+class LaneStats:
+    # 処理時間の移動平均の重み（新しい1件をどれだけ効かせるか）
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, service_guess=30.0):
+        self.done = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.service_total = 0.0
+        self.rejected = 0   # 混雑で受け付けなかった件数
+        self.shed = 0       # 間に合わない見込みで、処理せずに断った件数
+        # 1件あたりの処理時間の見込み（まだ実績が無い間は service_guess 秒）
+        self.service_ewma = service_guess
+
+    def add_service(self, seconds):
+        if self.done == 0:
+            self.service_ewma = seconds
+        else:
+            self.service_ewma += self.EWMA_ALPHA * (seconds - self.service_ewma)
+
+    def as_dict(self):
+        return {
+            "done": self.done,
+            "wait_avg": self.wait_total / self.done if self.done else 0.0,
+            "wait_max": self.wait_max,
+            "service_avg": self.service_total / self.done if self.done else 0.0,
+            "service_ewma": self.service_ewma,
+            "rejected": self.rejected,
+            "shed": self.shed,
+        }
+
+
+class RequestScheduler:
+    """
+    レーン（chat / pdf）ごとに優先度付きキューとワーカースレッドを持つスケジューラー。
+    長いPDF査読が走っていても、チャットの質問は自分のレーンのワーカーで先に答えられます。
+    各ワーカーは専用の AIEngine を1つずつ持ちます（engines で渡す）。
+    """
+
+    def __init__(self, engines, handler, service_guess=None):
+        """
+        engines: {"chat": [AIEngine, ...], "pdf": [AIEngine, ...]}  レーンごとのワーカー数 = エンジン数
+        handler: handler(engine, request) で1件を処理する関数
+        service_guess: {"chat": 秒, ...} 実績が無い間の1件あたりの処理時間の見込み
+        """
+        self.handler = handler
+        self._cond = threading.Condition()
+        self._queues = {lane: [] for lane in engines}
+        self._running = {lane: 0 for lane in engines}
+        self._active = {lane: {} for lane in engines}   # 処理中の依頼 {path: Request}
+        self._workers = {lane: len(lane_engines) for lane, lane_engines in engines.items()}
+        guess = service_guess or {}
+        self._stats = {lane: LaneStats(guess.get(lane, 30.0)) for lane in engines}
+        # 状態が変わるたびに増えます（status.txt を書き直すかどうかの判断用）
+        self.version = 0
+        self._known = set()
+        self._seq = itertools.count()
+        self._stopped = False
+
+        self._threads = []
+        for lane, lane_engines in engines.items():
+            for n, engine in enumerate(lane_engines):
+                th = threading.Thread(target=self._worker, args=(lane, engine), name=f"{lane}-{n}", daemon=True)
+                th.start()
+                self._threads.append(th)
+
+    # ----------------------------------------------------------------
+    # 受付
+    # ----------------------------------------------------------------
+    def is_known(self, path):
+        with self._cond:
+            return path in self._known
+
+    def submit(self, path, priority=0):
+        """まだ受け付けていないファイルなら、キューに積んで Request を返します"""
+        with self._cond:
+            if path in self._known: return None
+            req = Request(path, priority)
+            if req.lane not in self._queues: req.lane = "chat"
+            self._known.add(path)
+            heapq.heappush(self._queues[req.lane], (req.priority, req.ctime, next(self._seq), req))
+            self.version += 1
+            self._cond.notify_all()
+            return req
+
+    def queued(self, lane):
+        """そのレーンで順番待ちしている Request の一覧（写し）"""
+        with self._cond:
+            return [entry[3] for entry in self._queues.get(lane, [])]
+
+    def take(self, lane, paths):
+        """
+        順番待ちの中から paths の依頼を抜き取って返します（同じ質問をまとめて答える時など）。
+        抜き取った依頼は、答え終わったら complete() を呼んでください。
+        """
+        paths = set(paths)
+        with self._cond:
+            queue = self._queues.get(lane, [])
+            taken = [entry[3] for entry in queue if entry[3].path in paths]
+            if taken:
+                queue[:] = [entry for entry in queue if entry[3].path not in paths]
+                heapq.heapify(queue)
+                self.version += 1
+            now = time.time()
+            for req in taken: req.started_at = now
+            return taken
+
+    def retain(self, present):
+        """
+        ファイルが無くなった順番待ちの依頼を外します（複数台で動かす時に、他の台が受け取った分など）。
+        present に無くても、直後に置かれたばかりの依頼は消さないよう、ファイルの有無を確かめ直します。
+        """
+        present = set(present)
+        with self._cond:
+            dropped = 0
+            for lane, queue in self._queues.items():
+                gone = [entry for entry in queue if entry[3].path not in present and not os.path.exists(entry[3].path)]
+                if not gone: continue
+                queue[:] = [entry for entry in queue if entry not in gone]
+                heapq.heapify(queue)
+                for entry in gone: self._known.discard(entry[3].path)
+                dropped += len(gone)
+            if dropped: self.version += 1
+            return dropped
+
+    def estimate(self, lane, hosts=1):
+        """今から1件増えた場合の (そのレーンの待ち件数, 回答までの見込み秒, 1件の処理時間, 見込みが実績に基づくか)"""
+        st = self.status(hosts)[lane]
+        with self._cond:
+            measured = self._stats[lane].done > 0
+        return len(st["queued"]), st["next_eta"], st["service_ewma"], measured
+
+    def note_rejected(self, lane, shed=False):
+        """受付で断った件数（shed=True は順番が来た時に間に合わないと分かって断った件数）"""
+        with self._cond:
+            if shed: self._stats[lane].shed += 1
+            else: self._stats[lane].rejected += 1
+
+    def shed(self, lane, timeout, hosts=1):
+        """
+        順番待ちのうち、待ち始めてからの時間＋回答までの見込みが timeout を超える依頼を抜き取って返します。
+        処理時間の実績がまだ無い間は、見込みが当てにならないので何もしません。
+        待たずに始められる依頼は断りません（1件の処理時間が timeout より長くても、実績を更新できるように）。
+        """
+        now = time.time()
+        with self._cond:
+            st = self._stats.get(lane)
+            if st is None or st.done == 0: return []
+            ewma = st.service_ewma
+            workers = max(1, self._workers[lane] * max(1, hosts))
+            slot_wait = self._slot_wait(lane, now, workers, ewma)
+            kept, gone = [], []
+            for entry in sorted(self._queues[lane]):
+                req = entry[3]
+                # 前の依頼を断ると後ろの見込みが縮むので、残した件数で順番を数えます
+                eta = slot_wait + (len(kept) // workers) * ewma + ewma
+                if eta > ewma and now - req.enqueued_at + eta > timeout: gone.append(req)
+                else: kept.append(entry)
+            if gone:
+                self._queues[lane][:] = kept
+                heapq.heapify(self._queues[lane])
+                for req in gone: self._known.discard(req.path)
+                st.shed += len(gone)
+                self.version += 1
+            return gone
+
+    def complete(self, req, counted=True):
+        """counted=False は処理しなかった依頼（他の台に先に取られた時など）で、処理時間の実績に入れません"""
+        with self._cond:
+            self._known.discard(req.path)
+            self.version += 1
+            if not counted: return
+            st = self._stats[req.lane]
+            waited = req.started_at - req.enqueued_at
+            service = time.time() - req.started_at
+            st.add_service(service)
+            st.done += 1
+            st.wait_total += waited
+            st.wait_max = max(st.wait_max, waited)
+            st.service_total += service
+
+    # ----------------------------------------------------------------
+    # 処理
+    # ----------------------------------------------------------------
+    def _worker(self, lane, engine):
+        while True:
+            with self._cond:
+                while not self._queues[lane] and not self._stopped:
+                    self._cond.wait()
+                if self._stopped: return
+                _, _, _, req = heapq.heappop(self._queues[lane])
+                self._running[lane] += 1
+                req.started_at = time.time()
+                self._active[lane][req.path] = req
+                self.version += 1
+
+            waited = req.started_at - req.enqueued_at
+            print(f"\n⏳ [{lane}] {req.uid} 待ち時間 {waited:.1f}秒")
+            trace = METRICS.start(lane, req.uid, lane)
+            METRICS.observe("queue_wait", waited)
+            handled = True
+            try:
+                # handler が False を返したら、処理しなかった依頼として扱います
+                handled = self.handler(engine, req) is not False
+            except Exception as e:
+                print(f"処理エラー [{req.uid}]: {e}")
+            finally:
+                # 処理側が消し損ねた依頼は、二重処理にならないようここで消します
+                # （処理しなかった依頼は、まだ書き込み途中のこともあるので残します）
+                if handled and os.path.exists(req.path):
+                    try: os.remove(req.path)
+                    except OSError: pass
+                with self._cond:
+                    self._running[lane] -= 1
+                    self._active[lane].pop(req.path, None)
+                self.complete(req, handled)
+                if handled: METRICS.finish(trace)
+
+    def stats(self):
+        with self._cond:
+            return {
+                lane: dict(self._stats[lane].as_dict(), queued=len(self._queues[lane]), running=self._running[lane])
+                for lane in self._queues
+            }
+
+    def status(self, hosts=1):
+        """
+        レーンごとの待ち行列と、依頼ごとの順番・回答までの見込み秒数を返します。
+        見込みは「空きワーカーが出るまで」＋「前に並んでいる件数 ÷ ワーカー数 × 1件の時間」＋「自分の処理時間」です。
+        hosts: 同じ exchange_box を見ている台数（同じ構成と見なしてワーカー数を掛けます）
+        """
+        now = time.time()
+        with self._cond:
+            lanes = {}
+            for lane, queue in self._queues.items():
+                ewma = self._stats[lane].service_ewma
+                workers = max(1, self._workers[lane] * max(1, hosts))
+                active = list(self._active[lane].values())
+                slot_wait = self._slot_wait(lane, now, workers, ewma)
+                waiting = []
+                for pos, entry in enumerate(sorted(queue)):
+                    req = entry[3]
+                    eta = slot_wait + (pos // workers) * ewma + ewma
+                    waiting.append((req.uid, pos + 1, eta))
+                lanes[lane] = {
+                    "workers": workers,
+                    "service_ewma": ewma,
+                    "processing": [(r.uid, now - r.started_at, max(0.0, ewma - (now - r.started_at))) for r in active],
+                    "queued": waiting,
+                    # 今から1件増えた場合の見込み（最後尾の次）
+                    "next_eta": slot_wait + (len(queue) // workers) * ewma + ewma,
+                }
+            return lanes
+
+    def _slot_wait(self, lane, now, workers, ewma):
+        """全員が処理中なら、一番早く終わりそうなワーカーが空くまでの秒数（ロックを持って呼びます）"""
+        active = self._active[lane].values()
+        if len(active) < workers: return 0.0
+        return max(0.0, ewma - max(now - r.started_at for r in active))
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()